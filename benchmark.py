@@ -0,0 +1,264 @@
+"""
+Micro-benchmarks for the document index.
+
+Usage:
+    python benchmark.py search [--sizes 1000 10000 100000] [--dim 768]
+    python benchmark.py lexical [--sizes 1000 10000 100000]
+    python benchmark.py ann [--size 100000] [--nprobe 1 4 8 16 32]
+    python benchmark.py storage [--size 100000] [--rescore-factor 4]
+    python benchmark.py shards [--size 100000] [--shards 10]
+    python benchmark.py load [--directory data] [--chats 10] [--generate-latency 1.0]
+"""
+import io
+import argparse
+import asyncio
+import tempfile
+import time
+from contextlib import redirect_stdout
+from typing import Callable, List
+import numpy as np
+
+from indexworker import DocumentIndex, IVFIndex, LexicalIndex
+from llmworker import FakeBackend
+from ollamaworker import OllamaDocumentQA
+
+
+def random_embeddings(count: int, dim: int, seed: int = 0) -> np.ndarray:
+    """Return `count` random float32 vectors of size `dim`."""
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((count, dim), dtype=np.float32)
+
+
+def time_call(fn: Callable, repeat: int) -> float:
+    """Return the median wall time of `fn()` in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+
+def legacy_search(qa: OllamaDocumentQA, document_embeddings: dict, question_embedding: List[float], top_k: int):
+    """The per-document loop find_relevant_documents used before the matrix index."""
+    similarities = []
+    for filename, doc_data in document_embeddings.items():
+        similarity = qa.cosine_similarity(question_embedding, doc_data['embedding'])
+        similarities.append((filename, similarity))
+    similarities.sort(key=lambda x: x[1], reverse=True)
+    return similarities[:top_k]
+
+
+def bench_search(sizes: List[int], dim: int, top_k: int, repeat: int, legacy_max: int) -> None:
+    """Compare the legacy Python loop with the vectorized DocumentIndex.search."""
+    qa = OllamaDocumentQA()
+    query = random_embeddings(1, dim, seed=1)[0]
+
+    print(f"{'vectors':>10} {'legacy ms':>12} {'matrix ms':>12} {'speedup':>10}")
+    for size in sizes:
+        vectors = random_embeddings(size, dim)
+        documents = [{'path': f"doc{i}.txt", 'passages': [[0, 0]]} for i in range(size)]
+        index = DocumentIndex("bench", "", documents, vectors)
+        matrix_ms = time_call(lambda: index.search(query, top_k), repeat)
+
+        if size <= legacy_max:
+            # The legacy path kept every embedding as a list of Python floats
+            legacy_embeddings = {doc['path']: {'embedding': vec.tolist()} for doc, vec in zip(documents, vectors)}
+            query_list = query.tolist()
+            legacy_ms = time_call(lambda: legacy_search(qa, legacy_embeddings, query_list, top_k), max(1, repeat // 10))
+            print(f"{size:>10} {legacy_ms:>12.2f} {matrix_ms:>12.3f} {legacy_ms / matrix_ms:>9.0f}x")
+        else:
+            print(f"{size:>10} {'-':>12} {matrix_ms:>12.3f} {'-':>10}")
+
+
+def random_passages(count: int, words_per_passage: int = 300, vocabulary_size: int = 50000, seed: int = 0) -> List[str]:
+    """Return synthetic passages with a Zipf-like word distribution."""
+    rng = np.random.default_rng(seed)
+    ids = np.minimum(rng.zipf(1.2, (count, words_per_passage)), vocabulary_size)
+    return [' '.join(f"w{i}" for i in row) for row in ids]
+
+
+def bench_lexical(sizes: List[int], top_k: int, repeat: int) -> None:
+    """BM25 query latency of LexicalIndex for a mix of rare and common terms."""
+    query = "w3 w250 w4000 fuse f3"
+
+    print(f"{'passages':>10} {'build s':>10} {'query ms':>10}")
+    for size in sizes:
+        passages = random_passages(size)
+        start = time.perf_counter()
+        lexical = LexicalIndex().updated(np.zeros(0, dtype=np.int64), size, list(enumerate(passages)))
+        build_s = time.perf_counter() - start
+        query_ms = time_call(lambda: lexical.search(query, top_k), repeat)
+        print(f"{size:>10} {build_s:>10.1f} {query_ms:>10.3f}")
+
+
+def clustered_embeddings(count: int, dim: int, clusters: int, seed: int = 0) -> np.ndarray:
+    """
+    Random vectors grouped around `clusters` centers. Real passage embeddings
+    cluster by topic; uniform noise would be a worst case no ANN index sees in practice.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    labels = rng.integers(0, clusters, count)
+    return centers[labels] + 1.5 * rng.standard_normal((count, dim), dtype=np.float32)
+
+
+def bench_ann(size: int, dim: int, top_k: int, nprobes: List[int], queries: int) -> None:
+    """Recall@k and latency of IVF search against exact search."""
+    vectors = clustered_embeddings(size + queries, dim, clusters=max(1, size // 100))
+    documents = [{'path': f"doc{i}.txt", 'passages': [[0, 0]]} for i in range(size)]
+    index = DocumentIndex("bench", "", documents, vectors[:size])
+    query_vectors = vectors[size:]
+
+    start = time.perf_counter()
+    index.ivf = IVFIndex.train(index.embeddings)
+    print(f"trained {len(index.ivf.centroids)} lists over {size} vectors in {time.perf_counter() - start:.1f}s")
+
+    exact = [{row for row, _ in index.search(q, top_k)} for q in query_vectors]
+    exact_ms = time_call(lambda: [index.search(q, top_k) for q in query_vectors], 3) / queries
+
+    print(f"{'nprobe':>8} {'recall@' + str(top_k):>10} {'ms/query':>10} {'speedup':>10}")
+    print(f"{'exact':>8} {1.0:>10.3f} {exact_ms:>10.3f} {1.0:>9.1f}x")
+    for nprobe in nprobes:
+        found = [{row for row, _ in index.search(q, top_k, nprobe=nprobe)} for q in query_vectors]
+        recall = np.mean([len(a & b) / len(b) for a, b in zip(found, exact)])
+        ann_ms = time_call(lambda: [index.search(q, top_k, nprobe=nprobe) for q in query_vectors], 3) / queries
+        print(f"{nprobe:>8} {recall:>10.3f} {ann_ms:>10.3f} {exact_ms / ann_ms:>9.1f}x")
+
+
+def bench_storage(size: int, dim: int, top_k: int, rescore_factor: int, queries: int) -> None:
+    """Memory, recall@k and latency of float16/int8 first-pass search with float32 rescoring."""
+    vectors = clustered_embeddings(size + queries, dim, clusters=max(1, size // 100))
+    documents = [{'path': f"doc{i}.txt", 'passages': [[0, 0]]} for i in range(size)]
+    query_vectors = vectors[size:]
+    exact_index = DocumentIndex("bench", "", documents, vectors[:size])
+    exact = [{row for row, _ in exact_index.search(q, top_k)} for q in query_vectors]
+
+    print(f"{'storage':>8} {'GB/1M vectors':>14} {'recall@' + str(top_k):>10} {'ms/query':>10}")
+    for storage in ["float32", "float16", "int8"]:
+        index = DocumentIndex("bench", "", documents, exact_index.embeddings, exact_index.norms,
+                              storage=storage, rescore_factor=rescore_factor)
+        matrix = index.embeddings if index.quantized is None else index.quantized
+        bytes_per_vector = matrix.itemsize * dim + (index.scales.itemsize if index.scales is not None else 0)
+        found = [{row for row, _ in index.search(q, top_k)} for q in query_vectors]
+        recall = np.mean([len(a & b) / len(b) for a, b in zip(found, exact)])
+        ms = time_call(lambda: [index.search(q, top_k) for q in query_vectors], 3) / queries
+        print(f"{storage:>8} {bytes_per_vector * 1e6 / 1e9:>14.2f} {recall:>10.3f} {ms:>10.3f}")
+
+
+def bench_shards(size: int, dim: int, top_k: int, shards: int, route: int, queries: int) -> None:
+    """Latency of a whole-library search against pinned and centroid-routed shard searches."""
+    # Each vendor's manuals cluster around their own topic
+    per_shard = size // shards
+    per_shard_queries = max(1, queries // shards)
+    shard_vectors = [clustered_embeddings(per_shard + per_shard_queries, dim, clusters=1, seed=s) for s in range(shards)]
+    documents = [{'path': f"vendor{s}/doc{i}.txt", 'passages': [[0, 0]]} for s in range(shards) for i in range(per_shard)]
+    index = DocumentIndex("bench", "", documents, np.vstack([v[:per_shard] for v in shard_vectors]))
+    query_vectors = np.vstack([v[per_shard:] for v in shard_vectors])
+    queries = len(query_vectors)
+
+    routed_ms = time_call(lambda: [index.search(q, top_k, shards=index.route(q, route)) for q in query_vectors], 3) / queries
+    exact = [{row for row, _ in index.search(q, top_k)} for q in query_vectors]
+    found = [{row for row, _ in index.search(q, top_k, shards=index.route(q, route))} for q in query_vectors]
+    recall = np.mean([len(a & b) / len(b) for a, b in zip(found, exact)])
+
+    print(f"{'search':>16} {'ms/query':>10} {'recall@' + str(top_k):>10}")
+    print(f"{'all shards':>16} {time_call(lambda: [index.search(q, top_k) for q in query_vectors], 3) / queries:>10.3f} {1.0:>10.3f}")
+    print(f"{'pinned shard':>16} {time_call(lambda: [index.search(q, top_k, shards=['vendor0']) for q in query_vectors], 3) / queries:>10.3f} {'-':>10}")
+    print(f"{'routed to ' + str(route):>16} {routed_ms:>10.3f} {recall:>10.3f}")
+
+
+def bench_load(directory: str, chats: int, questions: int, workers: int, generate_latency: float,
+               token_latency: float) -> None:
+    """Answer latency and throughput of concurrent chats, offline against the fake backend."""
+    backend = FakeBackend(generate_latency=generate_latency, token_latency=token_latency)
+    latencies = []
+
+    async def chat(chat_id: int, qa: OllamaDocumentQA) -> None:
+        for i in range(questions):
+            start = time.perf_counter()
+            # Distinct questions, so coalescing doesn't hide the load
+            await qa.ask_about_documents_async(f"How do I reset the controller, case {chat_id}.{i}?",
+                                               directory, chat=chat_id)
+            latencies.append(time.perf_counter() - start)
+
+    async def run(qa: OllamaDocumentQA) -> float:
+        start = time.perf_counter()
+        await asyncio.gather(*(chat(chat_id, qa) for chat_id in range(chats)))
+        return time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as index_path:
+        qa = OllamaDocumentQA(index_path=index_path, backend=backend, generation_workers=workers,
+                              max_queued_generations=chats * questions, fast_path=False)
+        with redirect_stdout(io.StringIO()):
+            qa.index_documents(directory)
+            elapsed = asyncio.run(run(qa))
+
+    print(f"{len(qa.index.documents)} documents, {chats} chats x {questions} questions, {workers} workers, "
+          f"{generate_latency:g}s + {token_latency:g}s/word per generation")
+    print(f"{'answers':>8} {'answers/s':>10} {'p50 s':>8} {'p95 s':>8} {'max s':>8}")
+    print(f"{len(latencies):>8} {len(latencies) / elapsed:>10.2f} {np.percentile(latencies, 50):>8.2f} "
+          f"{np.percentile(latencies, 95):>8.2f} {max(latencies):>8.2f}")
+    print(qa.scheduler.report())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DocBot index benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    search_parser = subparsers.add_parser("search", help="exact top-k search latency")
+    search_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    search_parser.add_argument("--dim", type=int, default=768)
+    search_parser.add_argument("--top-k", type=int, default=3)
+    search_parser.add_argument("--repeat", type=int, default=20)
+    search_parser.add_argument("--legacy-max", type=int, default=10000,
+                               help="largest size to run the old per-document loop on")
+
+    lexical_parser = subparsers.add_parser("lexical", help="BM25 query latency")
+    lexical_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    lexical_parser.add_argument("--top-k", type=int, default=12)
+    lexical_parser.add_argument("--repeat", type=int, default=100)
+
+    ann_parser = subparsers.add_parser("ann", help="IVF recall@k vs latency against exact search")
+    ann_parser.add_argument("--size", type=int, default=100000)
+    ann_parser.add_argument("--dim", type=int, default=768)
+    ann_parser.add_argument("--top-k", type=int, default=10)
+    ann_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    ann_parser.add_argument("--queries", type=int, default=100)
+
+    storage_parser = subparsers.add_parser("storage", help="float16/int8 memory and recall vs float32")
+    storage_parser.add_argument("--size", type=int, default=100000)
+    storage_parser.add_argument("--dim", type=int, default=768)
+    storage_parser.add_argument("--top-k", type=int, default=10)
+    storage_parser.add_argument("--rescore-factor", type=int, default=4)
+    storage_parser.add_argument("--queries", type=int, default=100)
+
+    shards_parser = subparsers.add_parser("shards", help="pinned and routed shard search vs whole library")
+    shards_parser.add_argument("--size", type=int, default=100000)
+    shards_parser.add_argument("--dim", type=int, default=768)
+    shards_parser.add_argument("--top-k", type=int, default=10)
+    shards_parser.add_argument("--shards", type=int, default=10)
+    shards_parser.add_argument("--route", type=int, default=2)
+    shards_parser.add_argument("--queries", type=int, default=100)
+
+    load_parser = subparsers.add_parser("load", help="concurrent chats against the fake LLM backend, offline")
+    load_parser.add_argument("--directory", default="data")
+    load_parser.add_argument("--chats", type=int, default=10)
+    load_parser.add_argument("--questions", type=int, default=3)
+    load_parser.add_argument("--workers", type=int, default=2)
+    load_parser.add_argument("--generate-latency", type=float, default=1.0)
+    load_parser.add_argument("--token-latency", type=float, default=0.0)
+
+    args = parser.parse_args()
+    if args.command == "search":
+        bench_search(args.sizes, args.dim, args.top_k, args.repeat, args.legacy_max)
+    elif args.command == "lexical":
+        bench_lexical(args.sizes, args.top_k, args.repeat)
+    elif args.command == "ann":
+        bench_ann(args.size, args.dim, args.top_k, args.nprobe, args.queries)
+    elif args.command == "storage":
+        bench_storage(args.size, args.dim, args.top_k, args.rescore_factor, args.queries)
+    elif args.command == "shards":
+        bench_shards(args.size, args.dim, args.top_k, args.shards, args.route, args.queries)
+    elif args.command == "load":
+        bench_load(args.directory, args.chats, args.questions, args.workers, args.generate_latency, args.token_latency)
@@ -0,0 +1,219 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from nltkworker import count_message_tokens, count_tokens
+
+
+def format_turns(messages: List[Dict[str, str]]) -> str:
+    """{"role", "content"} messages as "User: ..." / "Assistant: ..." lines."""
+    return "\n".join(f"{'User' if message['role'] == 'user' else 'Assistant'}: {message['content']}"
+                     for message in messages)
+
+
+class Conversation:
+    """What one chat has discussed, and what the generation model already holds of it."""
+
+    def __init__(self):
+        # Ollama's context tokens after the last answer: passing them back
+        # continues from the cached prompt instead of re-reading it
+        self.context = np.zeros(0, dtype=np.int32)
+        # Answers given on top of the current context
+        self.context_turns = 0
+        # (path, offset) of every passage already in the current context
+        self.passages: Set[Tuple[str, int]] = set()
+        # Recent turns as {"role", "content"} messages, and a summary of the older ones
+        self.history: List[Dict[str, str]] = []
+        self.summary = ""
+        self.history_tokens = 0
+        self.summarizing = False
+        self.turns = 0
+        self.last_used = time.monotonic()
+
+    def transcript(self) -> str:
+        """Summary and recent turns as prompt text."""
+        summary = f"Summary of the earlier conversation: {self.summary}\n" if self.summary else ""
+        return summary + format_turns(self.history)
+
+
+class ConversationStore:
+    """
+    Per-chat conversation state for follow-up questions.
+
+    Each chat keeps the model's context tokens for cheap follow-ups, plus its
+    recent turns and a running summary of older ones, bounded by
+    `history_budget` tokens: once over budget, the oldest turns are handed
+    out for summarization (see take_for_summary). The context tokens grow
+    with every answer, so after `max_turns` answers they are dropped and the
+    next question starts a fresh context from the summary and recent turns.
+
+    A conversation is dropped on clear(), once it has been idle for
+    `idle_timeout` seconds, and beyond `max_conversations` chats (least
+    recently used first). Safe to share between threads and the event loop.
+    """
+
+    def __init__(self, idle_timeout: float = 1800.0, max_turns: int = 8, max_conversations: int = 200,
+                 history_budget: int = 1500):
+        """
+        Args:
+            idle_timeout (float): Seconds without a question after which a conversation is forgotten
+            max_turns (int): Answers given on top of one context before it is rebuilt from the history
+            max_conversations (int): Conversations kept at once
+            history_budget (int): Tokens of summary plus recent turns kept per chat
+        """
+        self.idle_timeout = idle_timeout
+        self.max_turns = max_turns
+        self.max_conversations = max_conversations
+        self.history_budget = history_budget
+        # first_*: questions answered from scratch, follow_up_*: questions answered on top of a conversation
+        self.stats = {'first_questions': 0, 'first_prompt_tokens': 0, 'follow_ups': 0,
+                      'follow_up_prompt_tokens': 0, 'summaries': 0, 'summarized_turns': 0,
+                      'expired': 0, 'cleared': 0}
+        self._conversations: "OrderedDict[Hashable, Conversation]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, conversation: Conversation, now: float) -> bool:
+        return now - conversation.last_used >= self.idle_timeout
+
+    def get(self, chat: Hashable) -> Optional[Conversation]:
+        """
+        Return the chat's ongoing conversation, or None if it has none (or it
+        expired, in which case it is dropped).
+        """
+        with self._lock:
+            conversation = self._conversations.get(chat)
+            if conversation is None:
+                return None
+            if self._expired(conversation, time.monotonic()):
+                del self._conversations[chat]
+                self.stats['expired'] += 1
+                return None
+            return conversation
+
+    def reusable_context(self, conversation: Conversation) -> Optional[List[int]]:
+        """Context tokens a follow-up can continue from, or None if a fresh context is due."""
+        if not len(conversation.context) or conversation.context_turns >= self.max_turns:
+            return None
+        return conversation.context.tolist()
+
+    def remember(self, chat: Hashable, question: str, answer: str, context: Optional[List[int]],
+                 passages: Iterable[Tuple[str, int]], continued: bool, prompt_tokens: int = 0) -> Conversation:
+        """
+        Record an answer given in a chat.
+
+        Args:
+            chat (Hashable): Chat the answer was given in
+            question (str): The question
+            answer (str): The generated answer
+            context (Optional[List[int]]): Context tokens the model returned, None if the backend has none
+            passages (Iterable[Tuple[str, int]]): (path, offset) of the passages the question was answered from
+            continued (bool): Whether the answer was generated on top of the previous context
+            prompt_tokens (int): Prompt tokens the model had to evaluate for the answer
+
+        Returns:
+            Conversation: The chat's updated conversation
+        """
+        now = time.monotonic()
+        with self._lock:
+            conversation = self._conversations.get(chat)
+            if conversation is None or self._expired(conversation, now):
+                conversation = Conversation()
+                self._conversations[chat] = conversation
+            if conversation.turns:
+                self.stats['follow_ups'] += 1
+                self.stats['follow_up_prompt_tokens'] += prompt_tokens
+            else:
+                self.stats['first_questions'] += 1
+                self.stats['first_prompt_tokens'] += prompt_tokens
+
+            if not continued:
+                conversation.passages = set()
+                conversation.context_turns = 0
+            conversation.context = np.asarray(context or [], dtype=np.int32)
+            conversation.passages.update(passages)
+            conversation.context_turns += 1
+            turn = [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+            conversation.history.extend(turn)
+            conversation.history_tokens += count_message_tokens(turn)
+            conversation.turns += 1
+            conversation.last_used = now
+            self._conversations.move_to_end(chat)
+
+            # Forget idle chats, and the least recently used beyond the limit
+            for other in [other for other, state in self._conversations.items() if self._expired(state, now)]:
+                del self._conversations[other]
+                self.stats['expired'] += 1
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+                self.stats['expired'] += 1
+            return conversation
+
+    def take_for_summary(self, chat: Hashable) -> Optional[Tuple[str, List[Dict[str, str]]]]:
+        """
+        If the chat's history is over budget, hand out the oldest turns to be
+        folded into the summary: enough of them to bring it down to half the
+        budget, always keeping the latest turn. Call finish_summary with the
+        new summary afterwards.
+
+        While the next question can still continue from the model's context
+        tokens, the history isn't sent at all, so nothing is handed out: a
+        summary would only take a generation slot away from a question.
+
+        Returns:
+            Optional[Tuple[str, List[Dict[str, str]]]]: The current summary and the turns
+                to fold into it, or None if nothing needs summarizing
+        """
+        with self._lock:
+            conversation = self._conversations.get(chat)
+            if (conversation is None or conversation.summarizing
+                    or self.reusable_context(conversation) is not None
+                    or count_tokens(conversation.summary) + conversation.history_tokens <= self.history_budget):
+                return None
+            remaining = count_tokens(conversation.summary) + conversation.history_tokens
+            taken = 0
+            # Whole turns (question and answer), oldest first
+            while taken + 2 < len(conversation.history) and remaining > self.history_budget // 2:
+                remaining -= count_message_tokens(conversation.history[taken:taken + 2])
+                taken += 2
+            if not taken:
+                return None
+            conversation.summarizing = True
+            return conversation.summary, conversation.history[:taken]
+
+    def finish_summary(self, chat: Hashable, summary: Optional[str], turns: List[Dict[str, str]]) -> None:
+        """
+        Replace the turns handed out by take_for_summary with the new summary
+        (or keep them if summary is None, e.g. when summarizing failed).
+        """
+        with self._lock:
+            conversation = self._conversations.get(chat)
+            if conversation is None:
+                return
+            conversation.summarizing = False
+            # Turns can only have been appended since, so the handed out ones are still first
+            if summary is None or conversation.history[:len(turns)] != turns:
+                return
+            del conversation.history[:len(turns)]
+            conversation.history_tokens -= count_message_tokens(turns)
+            conversation.summary = summary
+            self.stats['summaries'] += 1
+            self.stats['summarized_turns'] += len(turns) // 2
+
+    def clear(self, chat: Hashable) -> bool:
+        """Forget a chat's conversation; returns whether it had one."""
+        with self._lock:
+            if self._conversations.pop(chat, None) is None:
+                return False
+            self.stats['cleared'] += 1
+            return True
+
+    def report(self) -> str:
+        """Return how much prompt evaluation follow-ups cost compared to first questions."""
+        stats = self.stats
+        first = stats['first_prompt_tokens'] / stats['first_questions'] if stats['first_questions'] else 0.0
+        follow_up = stats['follow_up_prompt_tokens'] / stats['follow_ups'] if stats['follow_ups'] else 0.0
+        return (f"Conversations: {len(self._conversations)} active, {stats['first_questions']} started, "
+                f"{stats['follow_ups']} follow-ups; avg prompt tokens {first:.0f} first, {follow_up:.0f} follow-up; "
+                f"{stats['summarized_turns']} turns folded into {stats['summaries']} summaries "
+                f"(budget {self.history_budget} tokens); {stats['expired']} expired, {stats['cleared']} cleared")
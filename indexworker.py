@@ -0,0 +1,937 @@
+import os
+import re
+import copy
+import json
+import hashlib
+import mmap
+import threading
+from collections import Counter, OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+INDEX_VERSION = 5
+MATRIX_FILE = "embeddings.npy"
+NORMS_FILE = "norms.npy"
+LEXICAL_FILE = "lexical.npz"
+IVF_FILE = "ivf.npz"
+QUANTIZED_FILES = {"float16": "embeddings.f16.npy", "int8": "embeddings.i8.npy"}
+SCALES_FILE = "scales.npy"
+METADATA_FILE = "index.json"
+
+TOKEN_PATTERN = re.compile(r'\w+')
+# Below this many passages the BM25 document-frequency cutoff is not applied
+MIN_CUTOFF_PASSAGES = 20
+
+
+def file_sha256(data: bytes) -> str:
+    """Return the hex sha256 digest of raw file bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def normalize_vector(vector) -> Tuple[np.ndarray, float]:
+    """
+    Return a float32 unit vector and the original norm.
+    Zero vectors stay zero so they score 0 instead of NaN.
+    """
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = float(np.linalg.norm(vector))
+    return (vector / norm if norm > 0 else vector), norm
+
+
+def _utf8_boundary(raw: bytes, pos: int) -> int:
+    """Move `pos` back until it no longer points into a UTF-8 continuation byte."""
+    while 0 < pos < len(raw) and (raw[pos] & 0xC0) == 0x80:
+        pos -= 1
+    return pos
+
+
+def split_passages(raw: bytes, passage_bytes: int = 2000, overlap_bytes: int = 200) -> List[Tuple[int, int]]:
+    """
+    Split raw file bytes into overlapping passages.
+
+    Passages end on whitespace where possible and never split a UTF-8
+    character, so every (offset, length) slice decodes cleanly.
+
+    Args:
+        raw (bytes): File content
+        passage_bytes (int): Target passage size in bytes
+        overlap_bytes (int): How many bytes consecutive passages share
+
+    Returns:
+        List[Tuple[int, int]]: (byte offset, byte length) of every passage
+    """
+    spans = []
+    size = len(raw)
+    start = 0
+
+    while start < size:
+        end = min(start + passage_bytes, size)
+        if end < size:
+            cut = max(raw.rfind(b' ', start, end), raw.rfind(b'\n', start, end))
+            end = cut + 1 if cut > start + passage_bytes // 2 else _utf8_boundary(raw, end)
+
+        if raw[start:end].strip():
+            spans.append((start, end - start))
+        if end >= size:
+            break
+
+        # Start the next passage on a word boundary inside the overlap
+        next_start = max(end - overlap_bytes, start + 1)
+        space = raw.find(b' ', next_start, end)
+        start = space + 1 if space != -1 else _utf8_boundary(raw, next_start)
+
+    return spans
+
+
+def shard_name(path: str) -> str:
+    """Shard of a document: its top-level directory, or '.' for files at the root."""
+    parts = Path(path).parts
+    return parts[0] if len(parts) > 1 else "."
+
+
+def _row_runs(rows: np.ndarray, min_run: int = 64) -> Optional[List[Tuple[int, int]]]:
+    """
+    Split sorted rows into contiguous [start, end) runs, or return None when
+    the runs are too short on average for slicing to beat a fancy-index copy.
+    """
+    if not len(rows):
+        return []
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    if (len(breaks) + 1) * min_run > len(rows):
+        return None
+    starts = rows[np.r_[0, breaks]]
+    ends = rows[np.r_[breaks - 1, len(rows) - 1]] + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def _matrix_runs(matrix: np.ndarray, rows: Optional[np.ndarray]) -> Tuple[np.ndarray, List[Tuple[int, int]]]:
+    """
+    Return a matrix and the [start, end) runs of it holding the given sorted
+    rows, in order. Shard ranges are sliced in place; scattered rows (IVF
+    candidates) are gathered into a copy.
+    """
+    if rows is None:
+        return matrix, [(0, len(matrix))]
+    runs = _row_runs(rows)
+    if runs is None:
+        return matrix[rows], [(0, len(rows))]
+    return matrix, runs
+
+
+def _take(matrix: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+    """Select sorted rows of a matrix; a contiguous run of rows is sliced without copying."""
+    if rows is None:
+        return matrix
+    if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+        return matrix[rows[0]:rows[-1] + 1]
+    return matrix[rows]
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens used by the lexical index."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def reciprocal_rank_fusion(rankings: List[List[Tuple[int, float]]], top_k: int, k: int = 60) -> List[Tuple[int, float]]:
+    """
+    Fuse several rankings of rows with reciprocal-rank fusion.
+
+    Only ranks matter, so cosine similarities and BM25 scores can be
+    combined without calibrating one against the other.
+
+    Args:
+        rankings (List[List[Tuple[int, float]]]): (row, score) lists, best first
+        top_k (int): Number of rows to return
+        k (int): RRF damping constant
+
+    Returns:
+        List[Tuple[int, float]]: (row, fused score) pairs, best first
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, (row, _) in enumerate(ranking):
+            fused[row] = fused.get(row, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+
+def quantize_embeddings(embeddings: np.ndarray, storage: str,
+                        chunk_rows: int = 32768) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+    """
+    Return a compact copy of unit rows for first-pass scoring.
+
+    float16 halves the matrix; int8 quarters it, with one float32 scale per
+    row (max |value| / 127) so every row uses the full int8 range.
+
+    Args:
+        embeddings (np.ndarray): Unit rows
+        storage (str): "float32" (no copy), "float16" or "int8"
+        chunk_rows (int): Rows converted at a time, so a memory-mapped matrix
+            is never fully materialized as float32
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (quantized matrix, per-row scales or None)
+    """
+    if storage == "float32":
+        return None, None
+    if storage == "float16":
+        return np.asarray(embeddings, dtype=np.float16), None
+    if storage != "int8":
+        raise ValueError(f"Unknown embedding storage '{storage}'")
+
+    quantized = np.empty(embeddings.shape, dtype=np.int8)
+    scales = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_rows):
+        chunk = np.asarray(embeddings[start:start + chunk_rows], dtype=np.float32)
+        chunk_scales = np.abs(chunk).max(axis=1) / 127.0 if chunk.size else np.zeros(len(chunk), dtype=np.float32)
+        chunk_scales[chunk_scales == 0] = 1.0
+        quantized[start:start + chunk_rows] = np.round(chunk / chunk_scales[:, None])
+        scales[start:start + chunk_rows] = chunk_scales
+    return quantized, scales
+
+
+def _write_atomic(path: Path, write) -> None:
+    """
+    Write a file next to its final location and rename it into place,
+    so a crash mid-write never leaves a half-written index behind.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class LexicalIndex:
+    """
+    Compact BM25 inverted index over passage rows.
+
+    Postings are stored in CSR form: the rows containing term t are
+    postings[indptr[t]:indptr[t + 1]], with their term frequencies in the
+    same slice of `frequencies`.
+    """
+
+    def __init__(self, terms: Optional[List[str]] = None, indptr: Optional[np.ndarray] = None,
+                 postings: Optional[np.ndarray] = None, frequencies: Optional[np.ndarray] = None,
+                 lengths: Optional[np.ndarray] = None, k1: float = 1.2, b: float = 0.75):
+        self.terms = list(terms) if terms is not None else []
+        self.vocabulary = {term: i for i, term in enumerate(self.terms)}
+        self.indptr = indptr if indptr is not None else np.zeros(1, dtype=np.int64)
+        self.postings = postings if postings is not None else np.zeros(0, dtype=np.int32)
+        self.frequencies = frequencies if frequencies is not None else np.zeros(0, dtype=np.uint16)
+        self.lengths = lengths if lengths is not None else np.zeros(0, dtype=np.float32)
+        self.k1 = k1
+        self.b = b
+        self.average_length = float(self.lengths.mean()) if len(self.lengths) else 0.0
+
+    def __len__(self) -> int:
+        """Number of passage rows."""
+        return len(self.lengths)
+
+    def updated(self, row_map: np.ndarray, row_count: int, fresh_rows: List[Tuple[int, str]]) -> "LexicalIndex":
+        """
+        Build the lexical index for the next DocumentIndex.
+
+        Args:
+            row_map (np.ndarray): New row of every current row, -1 for dropped rows
+            row_count (int): Number of rows in the new index
+            fresh_rows (List[Tuple[int, str]]): (new row, passage text) of every new passage
+
+        Returns:
+            LexicalIndex: New index
+        """
+        term_ids = np.repeat(np.arange(len(self.terms), dtype=np.int64), np.diff(self.indptr))
+        rows = row_map[self.postings] if len(self.postings) else np.zeros(0, dtype=np.int64)
+        keep = rows >= 0
+        term_parts = [term_ids[keep]]
+        row_parts = [rows[keep]]
+        frequency_parts = [self.frequencies[keep].astype(np.int64)]
+
+        lengths = np.zeros(row_count, dtype=np.float32)
+        kept_rows = row_map >= 0
+        lengths[row_map[kept_rows]] = self.lengths[kept_rows]
+
+        terms = list(self.terms)
+        vocabulary = dict(self.vocabulary)
+        for row, text in fresh_rows:
+            counts = Counter(tokenize(text))
+            lengths[row] = sum(counts.values())
+            for term in counts:
+                if term not in vocabulary:
+                    vocabulary[term] = len(terms)
+                    terms.append(term)
+            term_parts.append(np.array([vocabulary[term] for term in counts], dtype=np.int64))
+            row_parts.append(np.full(len(counts), row, dtype=np.int64))
+            frequency_parts.append(np.array(list(counts.values()), dtype=np.int64))
+
+        term_ids = np.concatenate(term_parts)
+        rows = np.concatenate(row_parts)
+        frequencies = np.concatenate(frequency_parts)
+
+        # Drop terms no passage contains any more, so the vocabulary doesn't
+        # keep every word of every removed passage across re-indexes
+        document_frequency = np.bincount(term_ids, minlength=len(terms))
+        present = document_frequency > 0
+        if not present.all():
+            new_ids = np.cumsum(present) - 1
+            term_ids = new_ids[term_ids]
+            terms = [term for term, keep_term in zip(terms, present) if keep_term]
+            document_frequency = document_frequency[present]
+
+        order = np.lexsort((rows, term_ids))
+        indptr = np.concatenate(([0], np.cumsum(document_frequency))).astype(np.int64)
+
+        return LexicalIndex(terms, indptr, rows[order].astype(np.int32),
+                            np.minimum(frequencies[order], np.iinfo(np.uint16).max).astype(np.uint16),
+                            lengths, self.k1, self.b)
+
+    def search(self, query: str, top_k: int = 3, max_document_frequency: float = 0.5,
+               allowed: Optional[np.ndarray] = None,
+               min_cutoff_passages: int = MIN_CUTOFF_PASSAGES) -> List[Tuple[int, float]]:
+        """
+        BM25 top-k over all passages.
+
+        Args:
+            query (str): Query text
+            top_k (int): Number of rows to return
+            max_document_frequency (float): Ignore query terms found in more than
+                this share of passages; their IDF is close to zero anyway
+            allowed (np.ndarray): Boolean mask of rows that may be returned
+            min_cutoff_passages (int): Only apply max_document_frequency from this
+                many passages on; in a tiny corpus every term is "frequent"
+
+        Returns:
+            List[Tuple[int, float]]: (row, BM25 score) pairs, best first
+        """
+        total = len(self)
+        term_ids = {self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary}
+        if not total or not term_ids:
+            return []
+
+        max_frequency = total * max_document_frequency if total >= min_cutoff_passages else total
+        row_parts = []
+        score_parts = []
+        for term_id in term_ids:
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            frequency = end - start
+            if frequency == 0 or frequency > max_frequency:
+                continue
+            rows = self.postings[start:end]
+            tf = self.frequencies[start:end].astype(np.float32)
+            if allowed is not None:
+                keep = allowed[rows]
+                rows = rows[keep]
+                tf = tf[keep]
+            idf = np.log(1.0 + (total - frequency + 0.5) / (frequency + 0.5))
+            length_norm = self.k1 * (1.0 - self.b + self.b * self.lengths[rows] / self.average_length)
+            row_parts.append(rows)
+            score_parts.append(idf * tf * (self.k1 + 1.0) / (tf + length_norm))
+
+        if not row_parts:
+            return []
+
+        rows, inverse = np.unique(np.concatenate(row_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        k = min(top_k, scores.shape[0])
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def save(self, path: Path) -> None:
+        """Write the postings to a single .npz file."""
+        _write_atomic(path, lambda f: np.savez(f, terms=np.array(self.terms, dtype=str), indptr=self.indptr,
+                                                postings=self.postings, frequencies=self.frequencies,
+                                                lengths=self.lengths))
+
+    @classmethod
+    def load(cls, path: Path) -> "LexicalIndex":
+        """Read postings written by save()."""
+        with np.load(path) as data:
+            return cls(data['terms'].tolist(), data['indptr'], data['postings'], data['frequencies'], data['lengths'])
+
+
+def _assign_to_centroids(vectors: np.ndarray, centroids: np.ndarray, chunk_rows: int = 16384) -> np.ndarray:
+    """Return the nearest (max inner product) centroid of every vector, in chunks to bound memory."""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_rows):
+        assignments[start:start + chunk_rows] = np.argmax(vectors[start:start + chunk_rows] @ centroids.T, axis=1)
+    return assignments
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest neighbour index.
+
+    A spherical k-means coarse quantizer splits the unit rows into `nlist`
+    lists. A query only scores the rows in the `nprobe` lists whose centroids
+    are closest to it, instead of every row.
+    """
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, trained_size: int):
+        """
+        Args:
+            centroids (np.ndarray): (nlist, dim) unit centroids
+            assignments (np.ndarray): List of every row
+            trained_size (int): Number of rows when the centroids were trained
+        """
+        self.centroids = centroids
+        self.assignments = assignments
+        self.trained_size = trained_size
+
+        # Rows grouped by list: list c holds order[offsets[c]:offsets[c + 1]]
+        self.order = np.argsort(assignments, kind='stable').astype(np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))))
+
+    @classmethod
+    def train(cls, embeddings: np.ndarray, nlist: Optional[int] = None, iterations: int = 10,
+              sample_per_list: int = 64, seed: int = 0) -> "IVFIndex":
+        """
+        Train the coarse quantizer on a sample of unit rows and assign every row.
+
+        Args:
+            embeddings (np.ndarray): Unit rows
+            nlist (int): Number of lists (defaults to sqrt of the row count)
+            iterations (int): k-means iterations
+            sample_per_list (int): Training rows per list
+            seed (int): Random seed
+
+        Returns:
+            IVFIndex: Trained index
+        """
+        rng = np.random.default_rng(seed)
+        count = len(embeddings)
+        nlist = min(nlist or max(1, int(np.sqrt(count))), count)
+        sample = np.asarray(embeddings[np.sort(rng.choice(count, min(count, nlist * sample_per_list), replace=False))],
+                            dtype=np.float32)
+
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = _assign_to_centroids(sample, centroids)
+            order = np.argsort(assignments, kind='stable')
+            counts = np.bincount(assignments, minlength=nlist)
+            filled = np.flatnonzero(counts)
+            sums = np.add.reduceat(sample[order], np.concatenate(([0], np.cumsum(counts)))[filled], axis=0)
+            centroids[filled] = sums
+            # Reseed empty lists with random sample rows
+            empty = np.flatnonzero(counts == 0)
+            if len(empty):
+                centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        return cls(centroids, _assign_to_centroids(embeddings, centroids), count)
+
+    def updated(self, row_map: np.ndarray, row_count: int, fresh_rows: np.ndarray,
+                embeddings: np.ndarray) -> "IVFIndex":
+        """
+        Carry the lists over to the next DocumentIndex: kept rows keep their
+        list, new rows are assigned to the existing centroids.
+
+        Args:
+            row_map (np.ndarray): New row of every current row, -1 for dropped rows
+            row_count (int): Number of rows in the new index
+            fresh_rows (np.ndarray): New rows that need an assignment
+            embeddings (np.ndarray): Unit rows of the new index
+
+        Returns:
+            IVFIndex: New index
+        """
+        assignments = np.zeros(row_count, dtype=np.int32)
+        kept = row_map >= 0
+        assignments[row_map[kept]] = self.assignments[kept]
+        if len(fresh_rows):
+            assignments[fresh_rows] = _assign_to_centroids(embeddings[fresh_rows], self.centroids)
+        return IVFIndex(self.centroids, assignments, self.trained_size)
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """Return the rows in the `nprobe` lists closest to a unit query."""
+        nprobe = min(nprobe, len(self.centroids))
+        scores = self.centroids @ query
+        probe = np.argpartition(scores, -nprobe)[-nprobe:]
+        return np.sort(np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe]))
+
+    def save(self, path: Path) -> None:
+        """Write centroids and assignments to a single .npz file."""
+        _write_atomic(path, lambda f: np.savez(f, centroids=self.centroids, assignments=self.assignments,
+                                                trained_size=np.array(self.trained_size)))
+
+    @classmethod
+    def load(cls, path: Path) -> "IVFIndex":
+        """Read an index written by save()."""
+        with np.load(path) as data:
+            return cls(data['centroids'], data['assignments'], int(data['trained_size']))
+
+
+class DocumentIndex:
+    """
+    Passage embedding matrix plus per-document metadata.
+
+    Each document entry holds path, size, mtime_ns and sha256 of the file it
+    was built from, so a later indexing run can tell which files still match
+    their stored embeddings, the (offset, length) byte spans of its passages
+    and the fault codes found in each passage. Every passage owns one row of
+    `embeddings`; rows are laid out document by document in `documents` order.
+
+    Rows are stored L2-normalized in one contiguous float32 matrix, with the
+    original norms cached in `norms`, so cosine similarity against every
+    passage is a single matrix-vector product. A BM25 `lexical` index over the
+    same rows is built and persisted alongside, and optionally an `ivf`
+    index for approximate search over large libraries.
+
+    Rows are grouped by shard (top-level directory of the document), so a
+    search restricted to one vendor's shard scans only a slice of the matrix.
+
+    With float16 or int8 `storage`, searches score a compact `quantized` copy
+    of the matrix first and rescore only the best top_k * rescore_factor
+    candidates against the float32 rows, which stay memory-mapped on disk.
+    """
+
+    def __init__(self, embedding_model: str, root: str = "", documents: Optional[List[Dict]] = None,
+                 embeddings: Optional[np.ndarray] = None, norms: Optional[np.ndarray] = None,
+                 lexical: Optional[LexicalIndex] = None, ivf: Optional[IVFIndex] = None,
+                 storage: str = "float32", rescore_factor: int = 4,
+                 quantized: Optional[np.ndarray] = None, scales: Optional[np.ndarray] = None):
+        """
+        Args:
+            embedding_model (str): Model the embeddings were produced with
+            root (str): Resolved document root the paths are relative to
+            documents (List[Dict]): Metadata per document, including its passages
+            embeddings (np.ndarray): Unit-length rows when `norms` is given,
+                otherwise raw vectors that get normalized here
+            norms (np.ndarray): Original norm of every row
+            lexical (LexicalIndex): BM25 index over the same rows
+            ivf (IVFIndex): Approximate nearest neighbour lists over the same rows
+            storage (str): First-pass matrix type: "float32", "float16" or "int8"
+            rescore_factor (int): Candidates per result rescored in float32
+            quantized (np.ndarray): Stored quantized matrix, computed when not given
+            scales (np.ndarray): Stored per-row int8 scales
+        """
+        self.embedding_model = embedding_model
+        self.root = root
+        self.documents = documents or []
+
+        if embeddings is None:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+            norms = np.zeros(0, dtype=np.float32)
+        elif norms is None:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            norms = np.linalg.norm(embeddings, axis=1).astype(np.float32)
+            embeddings = embeddings / np.where(norms > 0, norms, 1)[:, None]
+
+        # Memory-mapped matrices from load() are already contiguous float32
+        if not isinstance(embeddings, np.memmap):
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.embeddings = embeddings
+        self.norms = norms
+        self.lexical = lexical if lexical is not None else LexicalIndex()
+        self.ivf = ivf
+        self.storage = storage
+        self.rescore_factor = rescore_factor
+        if storage != "float32" and quantized is None:
+            quantized, scales = quantize_embeddings(embeddings, storage)
+        self.quantized = quantized
+        self.scales = scales
+
+        # Row -> (document, offset, length) lookup tables
+        counts = np.array([len(doc['passages']) for doc in self.documents], dtype=np.int64)
+        spans = [span for doc in self.documents for span in doc['passages']]
+        self._starts = np.concatenate(([0], np.cumsum(counts)))
+        self.passage_document = np.repeat(np.arange(len(self.documents), dtype=np.int32), counts)
+        self.passage_spans = np.array(spans, dtype=np.int64).reshape(-1, 2)
+        self._documents = {doc['path']: i for i, doc in enumerate(self.documents)}
+
+        # Shard id of every row; shard centroids are computed on first routing
+        self.shard_names = sorted({shard_name(doc['path']) for doc in self.documents})
+        shard_ids = {name: i for i, name in enumerate(self.shard_names)}
+        document_shard = np.array([shard_ids[shard_name(doc['path'])] for doc in self.documents], dtype=np.int32)
+        self.passage_shard = document_shard[self.passage_document] if len(self.documents) else np.zeros(0, dtype=np.int32)
+        self._shard_centroids = None
+
+        # Normalized fault code -> passage rows mentioning it
+        fault_codes = {}
+        for i, doc in enumerate(self.documents):
+            for row, codes in enumerate(doc.get('codes', []), start=int(self._starts[i])):
+                for code in codes:
+                    fault_codes.setdefault(code, []).append(row)
+        self.fault_codes = {code: np.array(rows, dtype=np.int64) for code, rows in fault_codes.items()}
+
+    def __len__(self) -> int:
+        """Number of passages (matrix rows)."""
+        return len(self.passage_document)
+
+    def lookup(self, path: str) -> Optional[Dict]:
+        """Return the stored metadata for a relative path, or None."""
+        i = self._documents.get(path)
+        return self.documents[i] if i is not None else None
+
+    def embeddings_for(self, path: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the stored unit embedding rows and their original norms for a document."""
+        i = self._documents[path]
+        rows = slice(self._starts[i], self._starts[i + 1])
+        return self.embeddings[rows], self.norms[rows]
+
+    def passage(self, row: int) -> Tuple[str, int, int]:
+        """Return (path, byte offset, byte length) of a passage row."""
+        offset, length = self.passage_spans[row]
+        return self.documents[self.passage_document[row]]['path'], int(offset), int(length)
+
+    def fault_code_rows(self, codes: List[str]) -> np.ndarray:
+        """Return the rows mentioning any of the given normalized fault codes."""
+        rows = [self.fault_codes[code] for code in codes if code in self.fault_codes]
+        return np.unique(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
+
+    def shard_mask(self, shards: List[str]) -> np.ndarray:
+        """Boolean mask of the rows belonging to any of the given shards."""
+        ids = [i for i, name in enumerate(self.shard_names) if name in shards]
+        return np.isin(self.passage_shard, ids)
+
+    def shard_centroids(self) -> np.ndarray:
+        """Unit mean vector of every shard, in shard_names order."""
+        if self._shard_centroids is None:
+            centroids = np.zeros((len(self.shard_names), self.embeddings.shape[1]), dtype=np.float32)
+            for i in range(len(self.shard_names)):
+                centroids[i] = _take(self.embeddings, np.flatnonzero(self.passage_shard == i)).sum(axis=0)
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+            self._shard_centroids = centroids
+        return self._shard_centroids
+
+    def route(self, query_embedding, count: int) -> List[str]:
+        """
+        Pick the shards whose centroids are closest to a query.
+
+        Args:
+            query_embedding: Query vector (any norm)
+            count (int): Number of shards to pick
+
+        Returns:
+            List[str]: Shard names, best first (all shards when there are no more than `count`)
+        """
+        query, norm = normalize_vector(query_embedding)
+        if norm == 0 or len(self.shard_names) <= count or query.shape[0] != self.embeddings.shape[1]:
+            return list(self.shard_names)
+        scores = self.shard_centroids() @ query
+        return [self.shard_names[i] for i in np.argsort(scores)[::-1][:count]]
+
+    def updated(self, root: str, documents: List[Dict],
+                fresh: Dict[str, Tuple[np.ndarray, np.ndarray, List[str]]]) -> "DocumentIndex":
+        """
+        Build the next index from this one without touching it, so readers
+        holding the current index keep a consistent view.
+
+        Args:
+            root (str): Resolved document root of the new index
+            documents (List[Dict]): Metadata of every document of the new index, in row order
+            fresh (Dict[str, Tuple[np.ndarray, np.ndarray, List[str]]]): (unit rows, norms,
+                passage texts) of new or changed documents; all other documents
+                reuse their rows from this index
+
+        Returns:
+            DocumentIndex: New index
+        """
+        matrices = []
+        norms = []
+        row_map = np.full(len(self), -1, dtype=np.int64)
+        fresh_rows = []
+        row = 0
+        for doc in documents:
+            if doc['path'] in fresh:
+                matrix, doc_norms, texts = fresh[doc['path']]
+                fresh_rows.extend(zip(range(row, row + len(texts)), texts))
+            else:
+                i = self._documents[doc['path']]
+                matrix, doc_norms = self.embeddings_for(doc['path'])
+                row_map[self._starts[i]:self._starts[i + 1]] = np.arange(row, row + len(doc_norms))
+            matrices.append(matrix)
+            norms.append(doc_norms)
+            row += len(doc_norms)
+
+        if not matrices:
+            return DocumentIndex(self.embedding_model, root, storage=self.storage, rescore_factor=self.rescore_factor)
+        embeddings = np.vstack(matrices)
+        ivf = None
+        if self.ivf is not None:
+            ivf = self.ivf.updated(row_map, row, np.array([r for r, _ in fresh_rows], dtype=np.int64), embeddings)
+        return DocumentIndex(self.embedding_model, root, documents, embeddings, np.concatenate(norms),
+                             self.lexical.updated(row_map, row, fresh_rows), ivf, self.storage, self.rescore_factor)
+
+    def with_ivf(self, ivf: Optional[IVFIndex]) -> "DocumentIndex":
+        """Return a copy of this index that searches through `ivf`; this one, possibly published, is left as is."""
+        trained = copy.copy(self)
+        trained.ivf = ivf
+        return trained
+
+    def search(self, query_embedding, top_k: int = 3, rows: Optional[np.ndarray] = None,
+               nprobe: int = 0, shards: Optional[List[str]] = None) -> List[Tuple[int, float]]:
+        """
+        Cosine top-k over all passages, or over a subset of rows.
+
+        Args:
+            query_embedding: Query vector (any norm)
+            top_k (int): Number of rows to return
+            rows (np.ndarray): Only score these rows (sorted)
+            nprobe (int): When an IVF index exists and no rows are given, only
+                score the rows of the `nprobe` closest lists (0 = exact search)
+            shards (List[str]): Only score rows of these shards
+
+        Returns:
+            List[Tuple[int, float]]: (row, cosine similarity) pairs, best first
+        """
+        query, norm = normalize_vector(query_embedding)
+        if not len(self) or norm == 0 or query.shape[0] != self.embeddings.shape[1]:
+            return []
+        allowed = self.shard_mask(shards) if shards is not None else None
+        if rows is not None:
+            if allowed is not None:
+                rows = rows[allowed[rows]]
+        elif nprobe and self.ivf is not None:
+            rows = self.ivf.candidates(query, nprobe)
+            if allowed is not None:
+                rows = rows[allowed[rows]]
+            if len(rows) < top_k:
+                rows = np.flatnonzero(allowed) if allowed is not None else None
+        elif allowed is not None:
+            rows = np.flatnonzero(allowed)
+        if rows is not None and not len(rows):
+            return []
+
+        if self.quantized is None:
+            matrix, runs = _matrix_runs(self.embeddings, rows)
+            scores = np.concatenate([matrix[start:end] @ query for start, end in runs])
+        else:
+            # Cheap first pass on the quantized rows, then exact float32 scores for the best candidates
+            approximate = self._approximate_scores(query, rows)
+            k = min(top_k * self.rescore_factor, approximate.shape[0])
+            candidates = np.argpartition(approximate, -k)[-k:]
+            rows = np.sort(candidates if rows is None else rows[candidates])
+            scores = self.embeddings[rows] @ query
+
+        k = min(top_k, scores.shape[0])
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(row if rows is None else rows[row]), float(scores[row])) for row in top]
+
+    def _approximate_scores(self, query: np.ndarray, rows: Optional[np.ndarray] = None,
+                            chunk_rows: int = 2048) -> np.ndarray:
+        """
+        Inner products of a unit query with the quantized rows. NumPy has no
+        fast float16/int8 matmul, so rows are widened to float32 in chunks
+        small enough to stay in CPU cache.
+        """
+        matrix, runs = _matrix_runs(self.quantized, rows)
+        scores = np.concatenate([matrix[start:min(start + chunk_rows, end)].astype(np.float32) @ query
+                                 for run_start, end in runs for start in range(run_start, end, chunk_rows)])
+        if self.scales is not None:
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+    def save(self, index_path: str) -> "DocumentIndex":
+        """
+        Persist the index as a float32 .npy matrix, the BM25 postings and a
+        JSON metadata sidecar (documents with their passage spans).
+
+        This index is left untouched, since readers may be searching it; the
+        returned copy serves the float32 rows from the memory-mapped file,
+        so they only take page cache instead of heap memory.
+
+        Args:
+            index_path (str): Directory to write the index files into
+
+        Returns:
+            DocumentIndex: The same index, backed by the saved matrix
+        """
+        path = Path(index_path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        # Quantized rows of any storage mode belong to the matrix being
+        # replaced; drop them first, so an interrupted save can't leave
+        # outdated ones that still match the new matrix's shape
+        for name in list(QUANTIZED_FILES.values()) + [SCALES_FILE]:
+            if (path / name).exists():
+                os.remove(path / name)
+
+        matrix = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+        norms = np.ascontiguousarray(self.norms, dtype=np.float32)
+        metadata = {
+            "version": INDEX_VERSION,
+            "embedding_model": self.embedding_model,
+            "root": self.root,
+            "dimension": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+            "documents": self.documents,
+        }
+
+        _write_atomic(path / MATRIX_FILE, lambda f: np.save(f, matrix))
+        _write_atomic(path / NORMS_FILE, lambda f: np.save(f, norms))
+        if self.quantized is not None:
+            self._save_quantized(path)
+        self.lexical.save(path / LEXICAL_FILE)
+        if self.ivf is not None:
+            self.ivf.save(path / IVF_FILE)
+        elif (path / IVF_FILE).exists():
+            os.remove(path / IVF_FILE)
+        _write_atomic(path / METADATA_FILE,
+                      lambda f: f.write(json.dumps(metadata, ensure_ascii=False).encode('utf-8')))
+
+        saved = copy.copy(self)
+        if matrix.size:
+            saved.embeddings = np.load(path / MATRIX_FILE, mmap_mode='r')
+        return saved
+
+    def _save_quantized(self, path: Path) -> None:
+        """Write the quantized matrix (and int8 scales) next to the float32 one."""
+        quantized = np.ascontiguousarray(self.quantized)
+        _write_atomic(path / QUANTIZED_FILES[self.storage], lambda f: np.save(f, quantized))
+        if self.scales is not None:
+            scales = np.ascontiguousarray(self.scales)
+            _write_atomic(path / SCALES_FILE, lambda f: np.save(f, scales))
+
+    @classmethod
+    def load(cls, index_path: str, embedding_model: str, root: str, storage: str = "float32",
+             rescore_factor: int = 4) -> "DocumentIndex":
+        """
+        Load a persisted index, memory-mapping the embedding matrices.
+
+        Returns an empty index when nothing is stored yet, or when the stored
+        index was built for another model or another document root.
+
+        Args:
+            index_path (str): Directory the index was saved to
+            embedding_model (str): Model the caller embeds with
+            root (str): Resolved document root the caller indexes
+            storage (str): First-pass matrix type: "float32", "float16" or "int8"
+            rescore_factor (int): Candidates per result rescored in float32
+
+        Returns:
+            DocumentIndex: Loaded (or empty) index
+        """
+        empty = cls(embedding_model, root, storage=storage, rescore_factor=rescore_factor)
+        path = Path(index_path)
+
+        try:
+            with open(path / METADATA_FILE, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            if (metadata.get("version") != INDEX_VERSION
+                    or metadata.get("embedding_model") != embedding_model
+                    or metadata.get("root") != root):
+                return empty
+
+            embeddings = np.load(path / MATRIX_FILE, mmap_mode='r')
+            norms = np.load(path / NORMS_FILE)
+            lexical = LexicalIndex.load(path / LEXICAL_FILE)
+            documents = metadata["documents"]
+            passages = sum(len(doc['passages']) for doc in documents)
+            if (embeddings.ndim != 2 or embeddings.shape[0] != passages
+                    or norms.shape[0] != passages or len(lexical) != passages):
+                print(f"   ✗ Stored index in {index_path} is inconsistent, rebuilding")
+                return empty
+        except FileNotFoundError:
+            return empty
+        except Exception as e:
+            print(f"   ✗ Could not load stored index from {index_path}: {e}")
+            return empty
+
+        ivf = None
+        if (path / IVF_FILE).exists():
+            try:
+                ivf = IVFIndex.load(path / IVF_FILE)
+                if len(ivf.assignments) != passages:
+                    ivf = None
+            except Exception as e:
+                print(f"   ✗ Could not load ANN index from {index_path}: {e}")
+
+        quantized = None
+        scales = None
+        if storage != "float32":
+            try:
+                quantized = np.load(path / QUANTIZED_FILES[storage], mmap_mode='r')
+                scales = np.load(path / SCALES_FILE) if storage == "int8" else None
+                if quantized.shape != embeddings.shape or (scales is not None and len(scales) != passages):
+                    quantized = scales = None
+            except FileNotFoundError:
+                pass
+
+        index = cls(embedding_model, root, documents, embeddings, norms, lexical, ivf, storage, rescore_factor,
+                    quantized, scales)
+        if storage != "float32" and quantized is None:
+            # First start with this storage mode: keep the conversion for the next start
+            index._save_quantized(path)
+        return index
+
+
+class PassageStore:
+    """
+    Passage text read on demand from the indexed files.
+
+    The index only keeps (path, offset, length) per passage; the bytes are
+    sliced out of a read-only mmap of the file when a passage is needed, so
+    memory stays flat no matter how large the library is. A bounded LRU keeps
+    the hot passages (the ones questions keep landing on) decoded.
+    """
+
+    def __init__(self, max_passages: int = 512):
+        self.max_passages = max_passages
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, file_path: Path, offset: int, length: int, size: Optional[int] = None,
+             mtime_ns: Optional[int] = None) -> Optional[str]:
+        """
+        Return the decoded text of a passage.
+
+        Offsets are only valid for the version of the file that was indexed,
+        so when `size` and `mtime_ns` are given and the file on disk no longer
+        matches them, nothing is read.
+
+        Args:
+            file_path (Path): File the passage belongs to
+            offset (int): Byte offset of the passage
+            length (int): Byte length of the passage
+            size (int): Size of the file when it was indexed
+            mtime_ns (int): Modification time of the file when it was indexed
+
+        Returns:
+            Optional[str]: Passage text, None if the file changed (or vanished) since it was indexed
+        """
+        def current(stat) -> bool:
+            return size is None or (stat.st_size == size and stat.st_mtime_ns == mtime_ns)
+
+        try:
+            if not current(os.stat(file_path)):
+                return None
+        except FileNotFoundError:
+            return None
+
+        key = (str(file_path), offset, length, size, mtime_ns)
+        with self._lock:
+            text = self._cache.get(key)
+            if text is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return text
+            self.misses += 1
+
+        try:
+            with open(file_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                # The file may have been rewritten since the stat above
+                if not current(stat):
+                    return None
+                if stat.st_size == 0:
+                    data = b""  # mmap refuses empty files
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        data = mapped[offset:offset + length]
+        except FileNotFoundError:
+            return None
+        text = data.decode('utf-8', errors='ignore')
+
+        with self._lock:
+            self._cache[key] = text
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_passages:
+                self._cache.popitem(last=False)
+        return text
+
+    def clear(self) -> None:
+        """Drop every cached passage."""
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,476 @@
+"""
+Pluggable LLM backends: one interface for embedding, generation and
+streaming, whichever service answers.
+
+    OllamaBackend  - a local (or remote) Ollama server
+    OpenAIBackend  - the OpenAI API
+    FakeBackend    - deterministic and offline, for load tests; serve_fake_ollama
+                     exposes it as an Ollama-compatible HTTP server
+
+Usage:
+    python llmworker.py fake-server [--port 11434] [--generate-latency 0.5] [--token-latency 0.02]
+"""
+import json
+import time
+import zlib
+import asyncio
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import AsyncIterator, Dict, List, Optional, Union
+import requests
+from ollamaclient import AsyncOllamaClient
+from indexworker import tokenize
+
+Texts = Union[str, List[str]]
+
+
+class LLMBackend:
+    """
+    Interface every backend implements.
+
+    Generation results are dicts shaped like Ollama's /api/generate response:
+    the text under "response", plus whatever metadata the service reports
+    ("load_duration", "prompt_eval_count", "eval_count", "context"). Streams
+    yield chunks of the same shape, the last one with "done": True. Options a
+    service doesn't understand (like Ollama's keep_alive) are ignored by it.
+    """
+
+    name = "backend"
+
+    def __init__(self, embedding_model: str, generation_model: str):
+        self.embedding_model = embedding_model
+        self.generation_model = generation_model
+
+    def embed(self, texts: Texts, timeout: float = 30.0) -> List[List[float]]:
+        """
+        Embed one or more texts.
+
+        Args:
+            texts (Union[str, List[str]]): Text or batch of texts
+            timeout (float): Seconds before the request is abandoned
+
+        Returns:
+            List[List[float]]: One embedding per text
+        """
+        raise NotImplementedError
+
+    def generate(self, prompt: str, system: Optional[str] = None, max_tokens: Optional[int] = None,
+                 temperature: Optional[float] = None, timeout: float = 60.0, **options) -> Dict:
+        """
+        Generate a completion for a prompt.
+
+        Args:
+            prompt (str): Prompt text
+            system (str): Optional system prompt
+            max_tokens (int): Cap on generated tokens
+            temperature (float): Sampling temperature
+            timeout (float): Seconds before the request is abandoned
+            **options: Service specific request fields
+
+        Returns:
+            Dict: Generation result, the text under "response"
+        """
+        raise NotImplementedError
+
+    def chat(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None,
+             temperature: Optional[float] = None, timeout: float = 60.0) -> str:
+        """
+        Generate the next message of a conversation.
+
+        Args:
+            messages (List[Dict[str, str]]): {"role", "content"} messages
+            max_tokens (int): Cap on generated tokens
+            temperature (float): Sampling temperature
+            timeout (float): Seconds before the request is abandoned
+
+        Returns:
+            str: Text of the reply
+        """
+        raise NotImplementedError
+
+    def preload(self, model: str) -> float:
+        """Load a model so the next request doesn't wait for it; returns the seconds spent loading."""
+        return 0.0
+
+    async def embed_async(self, texts: Texts) -> List[List[float]]:
+        """embed without blocking the event loop."""
+        return await asyncio.to_thread(self.embed, texts)
+
+    async def generate_async(self, prompt: str, **options) -> Dict:
+        """generate without blocking the event loop."""
+        return await asyncio.to_thread(self.generate, prompt, **options)
+
+    async def generate_stream(self, prompt: str, **options) -> AsyncIterator[Dict]:
+        """
+        Streaming generate.
+
+        Yields:
+            Dict: Chunks with a text fragment under "response"; the last one has "done": True
+        """
+        yield dict(await self.generate_async(prompt, **options), done=True)
+
+    async def aclose(self) -> None:
+        """Release pooled connections."""
+
+
+class OllamaBackend(LLMBackend):
+    """Ollama over its HTTP API: requests for sync calls, a pooled AsyncOllamaClient for async ones."""
+
+    name = "Ollama"
+
+    def __init__(self, base_url: str = "http://localhost:11434", embedding_model: str = "embeddinggemma",
+                 generation_model: str = "gemma2:2b", keep_alive: Optional[str] = "30m", timeout: float = 90.0):
+        """
+        Args:
+            base_url (str): Base URL for Ollama API
+            embedding_model (str): Model to use for embeddings
+            generation_model (str): Model that writes the answers
+            keep_alive (str): How long Ollama keeps a model loaded after a request (Ollama duration)
+            timeout (float): Seconds before an async request is abandoned
+        """
+        super().__init__(embedding_model, generation_model)
+        self.base_url = base_url
+        self.keep_alive = keep_alive
+        # Pooled keep-alive connections for the async (Telegram) path
+        self.client = AsyncOllamaClient(base_url, timeout)
+
+    def _body(self, system: Optional[str], max_tokens: Optional[int], temperature: Optional[float], options: Dict) -> Dict:
+        """Request fields shared by the generate and chat endpoints."""
+        body = {"keep_alive": self.keep_alive, **options}
+        if system:
+            body["system"] = system
+        model_options = {}
+        if max_tokens is not None:
+            model_options["num_predict"] = max_tokens
+        if temperature is not None:
+            model_options["temperature"] = temperature
+        if model_options:
+            body["options"] = model_options
+        return body
+
+    def embed(self, texts: Texts, timeout: float = 30.0) -> List[List[float]]:
+        response = requests.post(
+            f"{self.base_url}/api/embed",
+            json={"model": self.embedding_model, "input": texts, "keep_alive": self.keep_alive},
+            timeout=timeout
+        )
+        response.raise_for_status()
+        return response.json()["embeddings"]
+
+    def generate(self, prompt: str, system: Optional[str] = None, max_tokens: Optional[int] = None,
+                 temperature: Optional[float] = None, timeout: float = 60.0, **options) -> Dict:
+        response = requests.post(
+            f"{self.base_url}/api/generate",
+            json={"model": self.generation_model, "prompt": prompt, "stream": False,
+                  **self._body(system, max_tokens, temperature, options)},
+            timeout=timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def chat(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None,
+             temperature: Optional[float] = None, timeout: float = 60.0) -> str:
+        response = requests.post(
+            f"{self.base_url}/api/chat",
+            json={"model": self.generation_model, "messages": messages, "stream": False,
+                  **self._body(None, max_tokens, temperature, {})},
+            timeout=timeout
+        )
+        response.raise_for_status()
+        return response.json()["message"]["content"]
+
+    def preload(self, model: str) -> float:
+        # An empty generate (or a one word embed) loads the model without generating anything
+        if model == self.embedding_model:
+            endpoint, payload = "/api/embed", {"input": "warm up"}
+        else:
+            endpoint, payload = "/api/generate", {"prompt": "", "stream": False}
+        response = requests.post(f"{self.base_url}{endpoint}",
+                                 json={"model": model, "keep_alive": self.keep_alive, **payload}, timeout=300)
+        response.raise_for_status()
+        return response.json().get("load_duration", 0) / 1e9
+
+    async def embed_async(self, texts: Texts) -> List[List[float]]:
+        return await self.client.embed(self.embedding_model, texts, keep_alive=self.keep_alive)
+
+    async def generate_async(self, prompt: str, system: Optional[str] = None, max_tokens: Optional[int] = None,
+                             temperature: Optional[float] = None, **options) -> Dict:
+        return await self.client.generate(self.generation_model, prompt,
+                                          **self._body(system, max_tokens, temperature, options))
+
+    async def generate_stream(self, prompt: str, system: Optional[str] = None, max_tokens: Optional[int] = None,
+                              temperature: Optional[float] = None, **options) -> AsyncIterator[Dict]:
+        async for chunk in self.client.generate_stream(self.generation_model, prompt,
+                                                       **self._body(system, max_tokens, temperature, options)):
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+class OpenAIBackend(LLMBackend):
+    """The OpenAI API through the openai package (imported on first use)."""
+
+    name = "OpenAI"
+
+    def __init__(self, api_key: str, embedding_model: str = "text-embedding-3-small",
+                 generation_model: str = "gpt-4o-mini", timeout: float = 30.0):
+        """
+        Args:
+            api_key (str): OpenAI API key
+            embedding_model (str): Model to use for embeddings
+            generation_model (str): Model that writes the answers
+            timeout (float): Seconds before a request is abandoned
+        """
+        super().__init__(embedding_model, generation_model)
+        import openai
+        self.client = openai.OpenAI(api_key=api_key, timeout=timeout)
+        self.async_client = openai.AsyncOpenAI(api_key=api_key, timeout=timeout)
+
+    @staticmethod
+    def _messages(prompt: str, system: Optional[str]) -> List[Dict[str, str]]:
+        messages = [{"role": "system", "content": system}] if system else []
+        return messages + [{"role": "user", "content": prompt}]
+
+    @staticmethod
+    def _request_options(max_tokens: Optional[int], temperature: Optional[float], timeout: Optional[float] = None) -> Dict:
+        sampling = {} if timeout is None else {"timeout": timeout}
+        if max_tokens is not None:
+            sampling["max_tokens"] = max_tokens
+        if temperature is not None:
+            sampling["temperature"] = temperature
+        return sampling
+
+    @staticmethod
+    def _result(completion) -> Dict:
+        """An OpenAI chat completion in the shape of an Ollama generate response."""
+        result = {"response": completion.choices[0].message.content or "", "done": True}
+        if completion.usage is not None:
+            result["prompt_eval_count"] = completion.usage.prompt_tokens
+            result["eval_count"] = completion.usage.completion_tokens
+        return result
+
+    # Sync calls default to the client's timeout (timeout=None)
+
+    def embed(self, texts: Texts, timeout: Optional[float] = None) -> List[List[float]]:
+        response = self.client.embeddings.create(model=self.embedding_model, input=texts,
+                                                 **self._request_options(None, None, timeout))
+        return [item.embedding for item in response.data]
+
+    def generate(self, prompt: str, system: Optional[str] = None, max_tokens: Optional[int] = None,
+                 temperature: Optional[float] = None, timeout: Optional[float] = None, **options) -> Dict:
+        completion = self.client.chat.completions.create(model=self.generation_model,
+                                                         messages=self._messages(prompt, system),
+                                                         **self._request_options(max_tokens, temperature, timeout))
+        return self._result(completion)
+
+    def chat(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None,
+             temperature: Optional[float] = None, timeout: Optional[float] = None) -> str:
+        completion = self.client.chat.completions.create(model=self.generation_model, messages=messages,
+                                                         **self._request_options(max_tokens, temperature, timeout))
+        return completion.choices[0].message.content
+
+    async def embed_async(self, texts: Texts) -> List[List[float]]:
+        response = await self.async_client.embeddings.create(model=self.embedding_model, input=texts)
+        return [item.embedding for item in response.data]
+
+    async def generate_async(self, prompt: str, system: Optional[str] = None, max_tokens: Optional[int] = None,
+                             temperature: Optional[float] = None, **options) -> Dict:
+        completion = await self.async_client.chat.completions.create(model=self.generation_model,
+                                                                     messages=self._messages(prompt, system),
+                                                                     **self._request_options(max_tokens, temperature))
+        return self._result(completion)
+
+    async def generate_stream(self, prompt: str, system: Optional[str] = None, max_tokens: Optional[int] = None,
+                              temperature: Optional[float] = None, **options) -> AsyncIterator[Dict]:
+        stream = await self.async_client.chat.completions.create(model=self.generation_model,
+                                                                 messages=self._messages(prompt, system), stream=True,
+                                                                 **self._request_options(max_tokens, temperature))
+        async for event in stream:
+            if event.choices and event.choices[0].delta.content:
+                yield {"response": event.choices[0].delta.content, "done": False}
+        yield {"response": "", "done": True}
+
+    async def aclose(self) -> None:
+        await self.async_client.close()
+        self.client.close()
+
+
+class FakeBackend(LLMBackend):
+    """
+    Deterministic offline stand-in for load tests and development without a model.
+
+    Embeddings are hashed bags of words, so texts sharing words come out
+    close and retrieval behaves plausibly. Answers are a fixed text,
+    streamed word by word. Like Ollama, every result carries a "context"
+    (hashed ids of the prompt and answer words, appended to the context
+    passed in) and prompt_eval_count only counts the new prompt, so
+    follow-ups on a conversation can be exercised offline. Latencies are
+    simulated with sleeps.
+    """
+
+    name = "fake"
+
+    def __init__(self, dimension: int = 768, answer: str = "This is a canned answer from the fake backend.",
+                 embed_latency: float = 0.0, generate_latency: float = 0.0, token_latency: float = 0.0,
+                 embedding_model: str = "fake-embedding", generation_model: str = "fake-generation"):
+        """
+        Args:
+            dimension (int): Embedding size
+            answer (str): Text every generation returns
+            embed_latency (float): Seconds per embed request
+            generate_latency (float): Seconds before the first generated token
+            token_latency (float): Seconds per streamed word
+            embedding_model (str): Name reported as the embedding model
+            generation_model (str): Name reported as the generation model
+        """
+        super().__init__(embedding_model, generation_model)
+        self.dimension = dimension
+        self.answer = answer
+        self.embed_latency = embed_latency
+        self.generate_latency = generate_latency
+        self.token_latency = token_latency
+        self.stats = {'embed': 0, 'generate': 0}
+
+    def _vector(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimension
+        for word in tokenize(text) or [text]:
+            vector[zlib.crc32(word.encode('utf-8')) % self.dimension] += 1.0
+        return vector
+
+    def _vectors(self, texts: Texts) -> List[List[float]]:
+        self.stats['embed'] += 1
+        return [self._vector(text) for text in ([texts] if isinstance(texts, str) else texts)]
+
+    def _pieces(self) -> List[str]:
+        words = self.answer.split(' ')
+        return [words[0]] + [' ' + word for word in words[1:]]
+
+    def _result(self, prompt: str, context: Optional[List[int]] = None) -> Dict:
+        self.stats['generate'] += 1
+        prompt_tokens = tokenize(prompt)
+        new_tokens = [zlib.crc32(word.encode('utf-8')) % 32000 for word in prompt_tokens + tokenize(self.answer)]
+        return {"response": self.answer, "done": True, "load_duration": 0, "context": list(context or []) + new_tokens,
+                "prompt_eval_count": len(prompt_tokens), "eval_count": len(self._pieces())}
+
+    def embed(self, texts: Texts, timeout: float = 30.0) -> List[List[float]]:
+        time.sleep(self.embed_latency)
+        return self._vectors(texts)
+
+    def generate(self, prompt: str, system: Optional[str] = None, max_tokens: Optional[int] = None,
+                 temperature: Optional[float] = None, timeout: float = 60.0, **options) -> Dict:
+        time.sleep(self.generate_latency + self.token_latency * len(self._pieces()))
+        return self._result(prompt, options.get("context"))
+
+    def chat(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None,
+             temperature: Optional[float] = None, timeout: float = 60.0) -> str:
+        return self.generate("\n".join(message["content"] for message in messages))["response"]
+
+    async def embed_async(self, texts: Texts) -> List[List[float]]:
+        await asyncio.sleep(self.embed_latency)
+        return self._vectors(texts)
+
+    async def generate_async(self, prompt: str, **options) -> Dict:
+        await asyncio.sleep(self.generate_latency + self.token_latency * len(self._pieces()))
+        return self._result(prompt, options.get("context"))
+
+    async def generate_stream(self, prompt: str, **options) -> AsyncIterator[Dict]:
+        await asyncio.sleep(self.generate_latency)
+        for piece in self._pieces():
+            await asyncio.sleep(self.token_latency)
+            yield {"response": piece, "done": False}
+        yield dict(self._result(prompt, options.get("context")), response="")
+
+
+def create_backend(kind: str, **settings) -> LLMBackend:
+    """
+    Build a backend by name.
+
+    Args:
+        kind (str): "ollama", "openai" or "fake"
+        **settings: Constructor arguments of the backend
+
+    Returns:
+        LLMBackend: The backend
+    """
+    backends = {"ollama": OllamaBackend, "openai": OpenAIBackend, "fake": FakeBackend}
+    if kind not in backends:
+        raise ValueError(f"Unknown LLM backend '{kind}', expected one of: {', '.join(backends)}")
+    return backends[kind](**settings)
+
+
+def serve_fake_ollama(backend: FakeBackend = None, host: str = "127.0.0.1", port: int = 11434) -> ThreadingHTTPServer:
+    """
+    HTTP server answering /api/embed, /api/generate (streaming or not) and
+    /api/chat like Ollama does, from a FakeBackend. Point an OllamaBackend (or
+    anything else that talks to Ollama) at it to run offline.
+
+    Args:
+        backend (FakeBackend): Backend answering the requests (default settings if None)
+        host (str): Interface to bind
+        port (int): Port to bind
+
+    Returns:
+        ThreadingHTTPServer: The bound server; call serve_forever() to run it
+    """
+    backend = backend or FakeBackend()
+
+    class FakeOllamaHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, body: Dict) -> None:
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path == "/api/embed":
+                self._send_json({"model": body.get("model"), "embeddings": backend.embed(body.get("input", ""))})
+            elif self.path == "/api/chat":
+                reply = backend.chat(body.get("messages", []))
+                self._send_json({"model": body.get("model"), "message": {"role": "assistant", "content": reply}, "done": True})
+            elif self.path == "/api/generate" and body.get("stream", True):
+                # NDJSON, one chunk per word like Ollama's token stream
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                time.sleep(backend.generate_latency)
+                for piece in backend._pieces():
+                    time.sleep(backend.token_latency)
+                    self.wfile.write((json.dumps({"response": piece, "done": False}) + "\n").encode('utf-8'))
+                    self.wfile.flush()
+                final = dict(backend._result(body.get("prompt", ""), body.get("context")), response="")
+                self.wfile.write((json.dumps(final) + "\n").encode('utf-8'))
+            elif self.path == "/api/generate":
+                self._send_json(backend.generate(body.get("prompt", ""), context=body.get("context")))
+            else:
+                self.send_error(404)
+
+    return ThreadingHTTPServer((host, port), FakeOllamaHandler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fake = subparsers.add_parser("fake-server", help="Serve the fake backend over Ollama's HTTP API")
+    fake.add_argument("--host", default="127.0.0.1")
+    fake.add_argument("--port", type=int, default=11434)
+    fake.add_argument("--dimension", type=int, default=768)
+    fake.add_argument("--embed-latency", type=float, default=0.0)
+    fake.add_argument("--generate-latency", type=float, default=0.0)
+    fake.add_argument("--token-latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = serve_fake_ollama(FakeBackend(args.dimension, embed_latency=args.embed_latency,
+                                           generate_latency=args.generate_latency, token_latency=args.token_latency),
+                               args.host, args.port)
+    print(f"🧪 Fake Ollama listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -5,21 +5,52 @@ import re
 # Download required NLTK data (run once)
 # nltk.download('punkt')
 
+# Patterns for fault codes
+fault_code_patterns = [
+    r'\b[A-Z]{1,4}[0-9]{1,5}[A-Z]?\b',  # ABC123, AB12, A1B2, KSS01234, etc.
+    r'\b[Ff]ault\s+[Cc]ode\s*[A-Z0-9]+\b',
+    r'\b[Dd]iagnostic\s+[Tt]rouble\s+[Cc]ode\b',
+    r'\bDTC\s*[A-Z0-9]+\b',
+    r'\b[Ee]rror\s+[Cc]ode\s*[A-Z0-9]+\b',
+    r'\b[Pp]roblem\s+[Cc]ode\s*[A-Z0-9]+\b'
+]
+
+# Label words in front of a normalized code: 'FAULTCODE123' -> '123', 'DTCP0300' -> 'P0300'
+fault_code_label = re.compile(r'^(?:(?:FAULT|ERROR|PROBLEM)?CODE|DTC|DIAGNOSTICTROUBLECODE)')
+
+def normalize_fault_code(code):
+    """Uppercase a code and drop separators, so 'kss01234' and 'KSS-01234' match."""
+    return re.sub(r'[^A-Z0-9]', '', code.upper())
+
+def extract_fault_codes(text, ignore_case=False):
+    """
+    Return the normalized fault codes mentioned in text, in order of appearance.
+    Phrases like 'Fault code 123' yield just the code; matches without a digit are ignored.
+    Use ignore_case for user questions, where codes are often typed in lowercase.
+
+    >>> extract_fault_codes('Fault code 123 and DTC P0300')
+    ['123', 'P0300']
+    >>> extract_fault_codes('Fault code123', ignore_case=True)
+    ['123']
+    >>> extract_fault_codes('what does kss01234 mean?', ignore_case=True)
+    ['KSS01234']
+    """
+    flags = re.IGNORECASE if ignore_case else 0
+    positions = {}
+    for pattern in fault_code_patterns:
+        for match in re.finditer(pattern, text, flags):
+            # Drop the label words, also when the code is glued to them ('Fault code123')
+            code = fault_code_label.sub('', normalize_fault_code(match.group()))
+            if any(c.isdigit() for c in code):
+                positions[code] = min(positions.get(code, match.start()), match.start())
+    return sorted(positions, key=positions.get)
+
 def shorten_technical_text(text):
     """
     Keep only sentences about fault codes and plain instructions.
     Remove everything else.
     """
-    # Define patterns for fault codes and instructions
-    fault_code_patterns = [
-        r'\b[A-Z]{1,4}[0-9]{1,4}[A-Z]?\b',  # ABC123, AB12, A1B2, etc.
-        r'\b[Ff]ault\s+[Cc]ode\s*[A-Z0-9]+\b',
-        r'\b[Dd]iagnostic\s+[Tt]rouble\s+[Cc]ode\b',
-        r'\bDTC\s*[A-Z0-9]+\b',
-        r'\b[Ee]rror\s+[Cc]ode\s*[A-Z0-9]+\b',
-        r'\b[Pp]roblem\s+[Cc]ode\s*[A-Z0-9]+\b'
-    ]
-    
+    # Define patterns for instructions
     instruction_patterns = [
         r'\b[Ss]tep\s+\d+',
         r'\b[Ff]irst\b.*\bthen\b',
@@ -54,5 +85,13 @@ def shorten_technical_text(text):
     
     return ' '.join(relevant_sentences)
 
+# Same tokens as nltk's WordPunctTokenizer, compiled once
+word_punct_pattern = re.compile(r'\w+|[^\w\s]+')
+
 def count_tokens(text):
-    return len(nltk.WordPunctTokenizer().tokenize(text))
\ No newline at end of file
+    """Count word and punctuation tokens, fast enough to run on every chat message."""
+    return len(word_punct_pattern.findall(text))
+
+def count_message_tokens(messages):
+    """Total count_tokens of the content of {"role", "content"} messages."""
+    return sum(count_tokens(message["content"]) for message in messages)
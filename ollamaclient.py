@@ -0,0 +1,200 @@
+import json
+import time
+import random
+import threading
+from typing import AsyncIterator, Dict, List, Union
+import httpx
+import requests
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Ollama while the circuit breaker is open."""
+
+
+class EmbeddingError(ValueError):
+    """Ollama answered, but not with usable embeddings (wrong count, wrong size, zero vectors)."""
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    """Seconds to sleep before retry number `attempt` (0-based): exponential with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Whether a failed request is worth retrying: connection problems, timeouts
+    and 5xx answers are; 4xx answers (unknown model, bad request) and unusable
+    embeddings are not.
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError)):
+        return True
+    # requests and httpx HTTP errors, and the API errors of client libraries like openai
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        return status >= 500
+    # Client libraries wrap the transport error they ran into
+    return error.__cause__ is not None and is_retryable(error.__cause__)
+
+
+class CircuitBreaker:
+    """
+    Fails fast while a service is down instead of letting every caller wait
+    out its own timeouts and retries.
+
+    After `failure_threshold` failed calls in a row the circuit opens and
+    allow() refuses calls for `reset_timeout` seconds. Then one trial call is
+    let through (half-open): success closes the circuit, failure opens it
+    again. Safe to share between threads and the event loop.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0, name: str = "Ollama"):
+        """
+        Args:
+            failure_threshold (int): Failed calls in a row that open the circuit
+            reset_timeout (float): Seconds to fail fast before a trial call
+            name (str): Service name for the log lines
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """'closed', 'open' or 'half-open'."""
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allow(self) -> bool:
+        """Whether a call may be made now."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                print(f"🔌 {self.name} is reachable again, closing the circuit")
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def release(self) -> None:
+        """
+        End a call that neither succeeded nor failed, e.g. one that was
+        cancelled, so a half-open circuit lets the next trial through.
+        Harmless after record_success or record_failure.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"🔌 {self.failures} failed {self.name} calls in a row, failing fast for {self.reset_timeout:g}s")
+                self.opened_at = time.monotonic()
+
+
+class AsyncOllamaClient:
+    """
+    asyncio-native client for the Ollama HTTP API.
+
+    All requests share one httpx.AsyncClient, so connections to Ollama are
+    kept alive and reused instead of opening a new TCP connection per call,
+    and awaiting a slow generation leaves the event loop free for other chats.
+    The underlying client is created on first use, inside the running loop.
+    """
+
+    def __init__(self, base_url: str = "http://localhost:11434", timeout: float = 90.0,
+                 max_connections: int = 10, max_keepalive_connections: int = 5):
+        """
+        Args:
+            base_url (str): Base URL for Ollama API
+            timeout (float): Seconds before a request is abandoned
+            max_connections (int): Max concurrent connections to Ollama
+            max_keepalive_connections (int): Idle connections kept open for reuse
+        """
+        self.base_url = base_url
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections)
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    async def embed(self, model: str, texts: Union[str, List[str]], **options) -> List[List[float]]:
+        """
+        Embed one or more texts with /api/embed.
+
+        Args:
+            model (str): Embedding model
+            texts (Union[str, List[str]]): Text or batch of texts
+            **options: Extra request fields (e.g. keep_alive)
+
+        Returns:
+            List[List[float]]: One embedding per text
+        """
+        response = await self.client.post("/api/embed", json={"model": model, "input": texts, **options})
+        response.raise_for_status()
+        return response.json()["embeddings"]
+
+    async def generate(self, model: str, prompt: str, **options) -> Dict:
+        """
+        Run a non-streaming /api/generate request.
+
+        Args:
+            model (str): Generation model
+            prompt (str): Prompt text
+            **options: Extra request fields (e.g. keep_alive, context)
+
+        Returns:
+            Dict: Ollama's response body
+        """
+        response = await self.client.post("/api/generate", json={"model": model, "prompt": prompt, "stream": False, **options})
+        response.raise_for_status()
+        return response.json()
+
+    async def generate_stream(self, model: str, prompt: str, **options) -> AsyncIterator[Dict]:
+        """
+        Run a streaming /api/generate request.
+
+        Args:
+            model (str): Generation model
+            prompt (str): Prompt text
+            **options: Extra request fields (e.g. keep_alive, context)
+
+        Yields:
+            Dict: Each NDJSON chunk as Ollama sends it; the last one has "done": true
+        """
+        async with self.client.stream("POST", "/api/generate",
+                                      json={"model": model, "prompt": prompt, "stream": True, **options}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"])
+                yield chunk
+
+    async def aclose(self) -> None:
+        """Close the pooled connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
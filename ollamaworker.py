@@ -1,29 +1,272 @@
 import os
 import json
+import time
+import queue
+import asyncio
+import threading
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import numpy as np
-from typing import List, Dict, Tuple
-import requests
+from typing import AsyncIterator, Awaitable, Callable, Iterator, List, Dict, NamedTuple, Optional, Tuple
+from nltkworker import count_tokens, extract_fault_codes, normalize_fault_code
+from watchworker import DirectoryWatcher
+from llmworker import LLMBackend, OllamaBackend
+from chatworker import ConversationStore, format_turns
+from ollamaclient import CircuitBreaker, CircuitOpenError, EmbeddingError, backoff_delay, is_retryable
+from queueworker import GenerationScheduler, QueueFull, SingleFlight, question_key
+from indexworker import DocumentIndex, IVFIndex, PassageStore, file_sha256, normalize_vector, reciprocal_rank_fusion, shard_name, split_passages, tokenize
+
+# Words that don't change what a "what does <code> mean" question asks for
+FAST_PATH_FILLER_WORDS = {
+    "what", "whats", "does", "do", "is", "the", "a", "an", "mean", "means", "meaning", "code", "error",
+    "fault", "message", "alarm", "dtc", "problem", "about", "on", "of", "for", "explain", "tell", "me",
+    "info", "show", "kuka"
+}
+
+# A request whose model load took longer than this found the model evicted (cold)
+COLD_LOAD_SECONDS = 0.5
+
+
+class AnsweredTurn(NamedTuple):
+    """A generated answer, passed along with it so every chat it reaches can record the turn."""
+    # Chats that have recorded it, starting with the one it was generated for
+    chats: set
+    answer: str
+    relevant_docs: List[Tuple[str, int, float, str]]
+    response: Dict
 
 class OllamaDocumentQA:
-    def __init__(self, ollama_base_url: str = "http://localhost:11434", embedding_model: str = "embeddinggemma"):
+    def __init__(self, ollama_base_url: Optional[str] = None, embedding_model: Optional[str] = None,
+                 generation_model: Optional[str] = None,
+                 index_path: str = ".docbot_index", passage_bytes: int = 2000, overlap_bytes: int = 200,
+                 embed_batch_size: int = 32, embed_max_batch_bytes: int = 256000, refresh_interval: float = 60.0,
+                 hybrid_search: bool = True, fast_path: bool = True, fast_path_max_hits: int = 3,
+                 fast_path_max_extra_words: int = 2, ann: bool = True, ann_min_passages: int = 20000,
+                 nprobe: int = 8, storage: str = "float32", rescore_factor: int = 4, route_shards: int = 2,
+                 passage_cache_size: int = 512, index_readers: int = 4, embed_concurrency: int = 2,
+                 index_queue_size: int = 64, index_log_interval: float = 10.0, coalesce: bool = True,
+                 generation_workers: int = 2, max_queued_generations: int = 20, keep_alive: Optional[str] = None,
+                 keep_warm_interval: float = 240.0, business_hours: Tuple[int, int] = (7, 19),
+                 business_days: Tuple[int, ...] = (0, 1, 2, 3, 4), embed_retries: int = 3,
+                 breaker_failure_threshold: int = 3, breaker_reset_timeout: float = 30.0,
+                 backend: Optional[LLMBackend] = None, conversation_idle_timeout: float = 1800.0,
+                 conversation_max_turns: int = 8, conversation_history_budget: int = 1500):
         """
         Initialize the Ollama Document QA system.
         
         Args:
-            ollama_base_url (str): Base URL for Ollama API
-            embedding_model (str): Model to use for embeddings
+            ollama_base_url (str): Base URL for Ollama API (default http://localhost:11434)
+            embedding_model (str): Model to use for embeddings (default embeddinggemma)
+            generation_model (str): Model that writes the answers (default gemma2:2b)
+            index_path (str): Directory where the embedding index is persisted
+            passage_bytes (int): Target size of an indexed passage in bytes
+            overlap_bytes (int): Bytes shared by consecutive passages
+            embed_batch_size (int): Max texts per /api/embed request
+            embed_max_batch_bytes (int): Max UTF-8 payload bytes per /api/embed request
+            refresh_interval (float): Seconds between index freshness checks in ask_about_documents
+            hybrid_search (bool): Fuse BM25 and embedding rankings instead of using embeddings alone
+            fast_path (bool): Answer plain fault-code questions straight from the index, without the LLM
+            fast_path_max_hits (int): Max passages a code may appear in for the fast path to trust it
+            fast_path_max_extra_words (int): Max non-filler words besides the code for a question to
+                count as a plain code lookup
+            ann (bool): Use an IVF approximate index once the library has ann_min_passages passages
+            ann_min_passages (int): Passage count from which the IVF index is trained
+            nprobe (int): IVF lists scanned per query; higher is slower but closer to exact
+            storage (str): Matrix used for the first search pass: "float32", "float16" or "int8";
+                the compact ones are rescored against the float32 rows
+            rescore_factor (int): Candidates per result rescored in float32 with compact storage
+            route_shards (int): Shards (top-level directories) whose vectors an unpinned question
+                scans, picked by closeness to the shard centroids; 0 scans every shard
+            passage_cache_size (int): Decoded passages kept in the LRU; passage text is
+                otherwise read from the files on demand
+            index_readers (int): Threads that stat, read, hash and split files while indexing
+            embed_concurrency (int): /api/embed requests in flight at once
+            index_queue_size (int): Capacity of each queue between the indexing stages
+            index_log_interval (float): Seconds between indexing throughput log lines
+            coalesce (bool): Let identical concurrent questions (same words, same shard)
+                share one retrieval and generation in the async paths
+            generation_workers (int): LLM generations the async paths run at once
+            max_queued_generations (int): Generations allowed to wait for a worker; more are
+                turned away with a busy reply
+            keep_alive (str): How long Ollama keeps a model loaded after a request (Ollama duration, default 30m)
+            keep_warm_interval (float): Seconds between keep-warm pings; keep it below keep_alive
+            business_hours (Tuple[int, int]): Local [start, end) hours in which models are kept warm
+            business_days (Tuple[int, ...]): Weekdays (Monday = 0) in which models are kept warm
+            embed_retries (int): Retries of a failed /api/embed request, with jittered exponential backoff
+            breaker_failure_threshold (int): Failed embedding calls in a row after which Ollama is
+                considered down and further calls fail fast
+            breaker_reset_timeout (float): Seconds to fail fast before trying Ollama again
+            backend (LLMBackend): Service that embeds and generates; defaults to an OllamaBackend
+                built from ollama_base_url, the two models and keep_alive, which are then
+                configured on the backend and can't be passed here
+            conversation_idle_timeout (float): Seconds after which a chat's follow-up context is forgotten
+            conversation_max_turns (int): Answers given on top of one Ollama context before the
+                next question starts a fresh one from the chat's summary and recent turns
+            conversation_history_budget (int): Tokens of summary plus recent turns kept per chat;
+                beyond it the oldest turns are summarized
         """
-        self.ollama_base_url = ollama_base_url
-        self.embedding_model = embedding_model
-        self.document_embeddings = {}
-        self.file_contents = {}
+        service_settings = {'ollama_base_url': ollama_base_url, 'embedding_model': embedding_model,
+                            'generation_model': generation_model, 'keep_alive': keep_alive}
+        if backend is None:
+            backend = OllamaBackend(ollama_base_url or "http://localhost:11434", embedding_model or "embeddinggemma",
+                                    generation_model or "gemma2:2b", keep_alive or "30m")
+        elif any(value is not None for value in service_settings.values()):
+            conflicting = ", ".join(name for name, value in service_settings.items() if value is not None)
+            raise ValueError(f"{conflicting} can't be combined with a backend; configure the backend instead")
+        self.backend = backend
+        self.ollama_base_url = getattr(backend, 'base_url', None)
+        self.embedding_model = backend.embedding_model
+        self.generation_model = backend.generation_model
+        self.coalesce = coalesce
+        self.single_flight = SingleFlight()
+        self.scheduler = GenerationScheduler(generation_workers, max_queued_generations)
+        # Only Ollama keeps models loaded for a while
+        self.keep_alive = getattr(backend, 'keep_alive', None)
+        self.keep_warm_interval = keep_warm_interval
+        self.business_hours = business_hours
+        self.business_days = business_days
+        # Per-chat context of the async paths, so follow-ups don't resend what the model has seen
+        self.conversations = ConversationStore(conversation_idle_timeout, conversation_max_turns,
+                                               history_budget=conversation_history_budget)
+        self._summaries = set()  # Running summarization tasks, referenced until done
+        self.latency_stats = {'cold': {'answers': 0, 'seconds': 0.0}, 'warm': {'answers': 0, 'seconds': 0.0}}
+        self._keep_warm = None
+        self._keep_warm_stop = threading.Event()
+        self.embed_retries = embed_retries
+        self.embedding_breaker = CircuitBreaker(breaker_failure_threshold, breaker_reset_timeout, self.backend.name)
+        # Size of the model's vectors: taken from the stored index or the first response
+        self.embedding_dimension = None
+        # Files whose embedding failed; their stored version (if any) stays searchable until a retry succeeds
+        self.needs_reembedding = set()
+        # Files rewritten since they were indexed; their passages are skipped until they are re-indexed
+        self.stale_files = set()
+        self.index_path = index_path
+        self.passage_bytes = passage_bytes
+        self.overlap_bytes = overlap_bytes
+        self.embed_batch_size = embed_batch_size
+        self.embed_max_batch_bytes = embed_max_batch_bytes
+        self.index_readers = index_readers
+        self.embed_concurrency = embed_concurrency
+        self.index_queue_size = index_queue_size
+        self.index_log_interval = index_log_interval
+        self.storage = storage
+        self.rescore_factor = rescore_factor
+        self.index = DocumentIndex(self.embedding_model, storage=storage, rescore_factor=rescore_factor)
+        self.refresh_interval = refresh_interval
+        self.hybrid_search = hybrid_search
+        self.fast_path = fast_path
+        self.fast_path_max_hits = fast_path_max_hits
+        self.fast_path_max_extra_words = fast_path_max_extra_words
+        self.ann = ann
+        self.ann_min_passages = ann_min_passages
+        self.nprobe = nprobe
+        self.route_shards = route_shards
+        self.fast_path_stats = {'questions': 0, 'hits': 0, 'hit_seconds': 0.0, 'llm_answers': 0, 'llm_seconds': 0.0}
+        self._last_update = 0.0
+        self.passages = PassageStore(passage_cache_size)
+        # Filled in by update_index, read by status_report from other threads
+        self.index_progress = {'state': 'idle', 'ready': False, 'files_checked': 0, 'files_total': 0,
+                               'passages_embedded': 0, 'passages_total': 0, 'started': 0.0, 'error': None}
+        self._builder = None
+        self._builder_lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self.watcher = None
         self.directory_listing = ""
         
     def set_directory(self, directory_path: str):
         self.directory_listing = qa_system.get_directory_listing_string(directory_path)
 
-    def get_embedding(self, text: str) -> List[float]:
+    def _check_embeddings(self, embeddings: List[List[float]], expected: int) -> List[List[float]]:
+        """
+        Make sure Ollama returned one usable vector per text, all of the model's
+        actual output size. The first vector seen fixes that size if the index
+        hasn't already.
+        
+        Raises:
+            EmbeddingError: Wrong count, wrong dimension or an all-zero vector
+        """
+        if len(embeddings) != expected:
+            raise EmbeddingError(f"expected {expected} embeddings, got {len(embeddings)}")
+        if self.embedding_dimension is None and embeddings:
+            self.embedding_dimension = len(embeddings[0])
+        for vector in embeddings:
+            if len(vector) != self.embedding_dimension:
+                raise EmbeddingError(f"{self.embedding_model} returned a {len(vector)}-dimensional embedding, "
+                                     f"expected {self.embedding_dimension}")
+            if not any(vector):
+                raise EmbeddingError(f"{self.embedding_model} returned an all-zero embedding")
+        return embeddings
+
+    def _request_embeddings(self, texts, timeout: float) -> List[List[float]]:
+        """
+        Embed through the backend with retries and jittered backoff, behind the circuit breaker.
+        
+        Args:
+            texts (Union[str, List[str]]): Text or batch of texts
+            timeout (float): Seconds per attempt
+            
+        Returns:
+            List[List[float]]: Checked embeddings, one per text
+            
+        Raises:
+            CircuitOpenError: Ollama is considered down, nothing was sent
+        """
+        if not self.embedding_breaker.allow():
+            raise CircuitOpenError(f"{self.backend.name} embeddings are failing, not trying again yet")
+        expected = 1 if isinstance(texts, str) else len(texts)
+        settled = False
+        try:
+            for attempt in range(self.embed_retries + 1):
+                try:
+                    embeddings = self.backend.embed(texts, timeout)
+                except Exception as e:
+                    if attempt < self.embed_retries and is_retryable(e):
+                        delay = backoff_delay(attempt)
+                        print(f"   ↻ Embedding request failed ({e}), retry {attempt + 1}/{self.embed_retries} in {delay:.1f}s")
+                        time.sleep(delay)
+                        continue
+                    settled = True
+                    self.embedding_breaker.record_failure()
+                    raise
+                # Ollama is up even if the vectors turn out unusable
+                settled = True
+                self.embedding_breaker.record_success()
+                return self._check_embeddings(embeddings, expected)
+        finally:
+            # Interrupted half-way (cancelled, KeyboardInterrupt): don't hold the half-open trial forever
+            if not settled:
+                self.embedding_breaker.release()
+
+    async def _request_embeddings_async(self, texts) -> List[List[float]]:
+        """_request_embeddings over the pooled async client."""
+        if not self.embedding_breaker.allow():
+            raise CircuitOpenError(f"{self.backend.name} embeddings are failing, not trying again yet")
+        expected = 1 if isinstance(texts, str) else len(texts)
+        settled = False
+        try:
+            for attempt in range(self.embed_retries + 1):
+                try:
+                    embeddings = await self.backend.embed_async(texts)
+                except Exception as e:
+                    if attempt < self.embed_retries and is_retryable(e):
+                        delay = backoff_delay(attempt)
+                        print(f"   ↻ Embedding request failed ({e}), retry {attempt + 1}/{self.embed_retries} in {delay:.1f}s")
+                        await asyncio.sleep(delay)
+                        continue
+                    settled = True
+                    self.embedding_breaker.record_failure()
+                    raise
+                settled = True
+                self.embedding_breaker.record_success()
+                return self._check_embeddings(embeddings, expected)
+        finally:
+            # A cancelled question mustn't hold the half-open trial forever
+            if not settled:
+                self.embedding_breaker.release()
+
+    def get_embedding(self, text: str) -> Optional[List[float]]:
         """
         Get embedding for text using Ollama.
         
@@ -31,24 +274,22 @@ class OllamaDocumentQA:
             text (str): Text to embed
             
         Returns:
-            List[float]: Embedding vector
+            Optional[List[float]]: Embedding vector, or None if Ollama couldn't provide one
         """
         try:
-            response = requests.post(
-                f"{self.ollama_base_url}/api/embed",
-                json={
-                    "model": self.embedding_model,
-                    "prompt": text
-                },
-                timeout=30
-            )
-            response.raise_for_status()
-            return response.json()["embeddings"]
+            return self._request_embeddings(text, 30)[0]
         except Exception as e:
             print(f"Error getting embedding: {e}")
-            # Return a zero vector as fallback
-            return [0.0] * 1024  # Adjust size based on your model
-    
+            return None
+
+    def _embed_batch(self, batch: List[str]) -> List[Optional[List[float]]]:
+        """Embed one batch with a single backend request (thread-safe); None per text on failure."""
+        try:
+            return self._request_embeddings(batch, 30 + 5 * len(batch))
+        except Exception as e:
+            print(f"Error getting embeddings for a batch of {len(batch)}: {e}")
+            return [None] * len(batch)
+
     def cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
         """
         Calculate cosine similarity between two vectors.
@@ -102,79 +343,624 @@ class OllamaDocumentQA:
         
         return output_string.rstrip()
     
+    def _is_text_file(self, file_path: Path) -> bool:
+        """Whether a file looks like indexable text."""
+        if not file_path.is_file():
+            return False
+        if file_path.suffix in ['.txt', '.json', '.csv', '.pdf']:
+            return True
+        # Also include files without extensions that might be text
+        return file_path.suffix == "" and file_path.stat().st_size < 1000000  # < 1MB
+    
+    def _iter_text_files(self, base_path: Path) -> Iterator[Path]:
+        """Yield the files under base_path that look like indexable text, as they are found."""
+        for item in base_path.rglob("*"):
+            if self._is_text_file(item):
+                yield item
+
+    def _read_file(self, file_path: Path) -> bytes:
+        """Return the raw bytes of a file."""
+        with open(file_path, 'rb') as f:
+            return f.read()
+    
     def index_documents(self, directory_path: str = ".") -> None:
         """
         Index all documents in the directory by creating embeddings.
+
+        Every file is split into overlapping passages and each passage gets its
+        own embedding. Embeddings are persisted under `index_path`; see
+        `update_index` for how unchanged files reuse their stored passages.
         
         Args:
             directory_path (str): Path to directory to index
         """
         print("📚 Indexing documents...")
-        base_path = Path(directory_path)
-        
-        # Get all text files in directory and subdirectories
-        text_files = []
-        for ext in ['.txt', '.json', '.csv', '.pdf']:
-            text_files.extend(base_path.rglob(f"*{ext}"))
+        changes = self.update_index(directory_path)
+        # A full build, just like the background one: the watcher may now apply incremental updates
+        self.index_progress.update(state='ready', ready=True)
         
-        # Also include files without extensions that might be text
-        for item in base_path.rglob("*"):
-            if item.is_file() and item.suffix == "" and item.stat().st_size < 1000000:  # < 1MB
-                text_files.append(item)
+        print(f"✅ Indexed {len(self.index.documents)} documents, {len(self.index)} passages "
+              f"({len(changes['added'])} added, {len(changes['changed'])} changed, {len(changes['removed'])} removed)")
+    
+    def update_index(self, directory_path: str = ".", paths: List[str] = None) -> Dict[str, List[str]]:
+        """
+        Bring the index in line with the files on disk.
+
+        The tree is diffed against the manifest stored in the index (path,
+        size, mtime_ns, sha256). Files whose size and mtime match are not even
+        read; files whose content hash still matches keep their embeddings.
+        Only added or changed files are embedded, deleted files are dropped,
+        and the new index replaces the in-memory one and is persisted.
         
-        for file_path in text_files:
+        Args:
+            directory_path (str): Path to directory to index
+            paths (List[str]): Only re-check these files (absolute, or relative
+                to directory_path); every other indexed file is kept as is
+            
+        Returns:
+            Dict[str, List[str]]: Relative paths that were 'added', 'changed' and 'removed'
+        """
+        # One writer at a time; readers never wait, they use whichever snapshot is published
+        with self._update_lock:
+            return self._update_index(directory_path, paths)
+
+    def _update_index(self, directory_path: str, paths: Optional[List[str]]) -> Dict[str, List[str]]:
+        """update_index without the writer lock."""
+        base_path = Path(directory_path)
+        root = str(base_path.resolve())
+
+        previous = self.index
+        if previous.root != root:
+            previous = DocumentIndex.load(self.index_path, self.embedding_model, root, self.storage, self.rescore_factor)
+            if len(previous):
+                print(f"   💾 Loaded {len(previous)} stored passage embeddings from {self.index_path}")
+                # Serve the stored snapshot while the tree is checked against it
+                self.index = previous
+        if len(previous) and self.embedding_dimension is None:
+            self.embedding_dimension = previous.embeddings.shape[1]
+
+        if paths is None:
+            candidates = ((str(file_path.relative_to(base_path)), file_path) for file_path in self._iter_text_files(base_path))
+            checked = {doc['path'] for doc in previous.documents}
+        else:
+            candidates = {}
+            checked = set()
+            for path in paths:
+                file_path = Path(path) if Path(path).is_absolute() else base_path / path
+                try:
+                    relative_path = str(file_path.resolve().relative_to(root))
+                except ValueError:
+                    continue  # Outside the indexed directory
+                checked.add(relative_path)
+                if self._is_text_file(file_path):
+                    candidates[relative_path] = base_path / relative_path
+            candidates = iter(candidates.items())
+
+        # Everything not re-checked is kept as is; the rest comes back out of the pipeline
+        kept = [doc for doc in previous.documents if doc['path'] not in checked]
+        documents, fresh, changes, touched = self._index_pipeline(candidates, previous)
+        documents = kept + documents
+
+        indexed = {doc['path'] for doc in documents}
+        changes['removed'] = sorted(doc['path'] for doc in previous.documents if doc['path'] not in indexed)
+
+        if not touched and not any(changes.values()):
+            # Nothing to rebuild, the (possibly just loaded) index is current
+            index = previous
+            rebuilt = False
+        else:
+            # Keep every shard's rows contiguous so a shard search scans a slice
+            documents.sort(key=lambda doc: (shard_name(doc['path']), doc['path']))
+            index = previous.updated(root, documents, fresh)
+            rebuilt = True
+
+        trained = self._train_ann(index)
+        if trained is not None:
+            index = trained
+        if trained is not None or rebuilt:
             try:
-                # Skip binary files and very large files
-                if file_path.stat().st_size > 5000000:  # Skip files > 5MB
-                    continue
-                    
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
+                index = index.save(self.index_path)
+            except Exception as e:
+                print(f"   ✗ Could not save index to {self.index_path}: {e}")
+
+        # Publish by swapping one reference; a search that already picked up the
+        # previous snapshot finishes on it
+        self.index = index
+        self._last_update = time.monotonic()
+        # Deleted files no longer need embedding
+        self.needs_reembedding = {path for path in self.needs_reembedding if (base_path / path).is_file()}
+        self.stale_files -= checked
+        return changes
+    
+    def _prepare_document(self, relative_path: str, file_path: Path, stored: Optional[Dict]) -> Tuple[str, Optional[Dict], List[str]]:
+        """
+        Reader stage: decide what a candidate file needs.
+
+        Returns:
+            Tuple[str, Optional[Dict], List[str]]: ('skip', None, []), ('keep', stored, []) when
+                size and mtime match the manifest, ('touched', document, []) when only the mtime
+                changed, or ('embed', document, passage texts) for new or modified content
+        """
+        try:
+            stat = file_path.stat()
+
+            # Skip binary files and very large files
+            if stat.st_size > 5000000:  # Skip files > 5MB
+                return 'skip', None, []
+
+            # Unchanged size and mtime: trust the manifest without reading the file
+            if stored is not None and stored['size'] == stat.st_size and stored['mtime_ns'] == stat.st_mtime_ns:
+                return 'keep', stored, []
+
+            raw = self._read_file(file_path)
+            
+            # Only index files with reasonable content
+            if len(raw.decode('utf-8', errors='ignore').strip()) <= 10:  # At least 10 characters of content
+                return 'skip', None, []
+
+            document = {
+                'path': relative_path,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sha256': file_sha256(raw)
+            }
+
+            if stored is not None and stored['sha256'] == document['sha256']:
+                # Touched but not modified, keep the stored passages
+                return 'touched', dict(stored, size=document['size'], mtime_ns=document['mtime_ns']), []
+
+            # One embedding per passage of the file
+            document['passages'] = [list(span) for span in split_passages(raw, self.passage_bytes, self.overlap_bytes)]
+            texts = [raw[offset:offset + length].decode('utf-8', errors='ignore') for offset, length in document['passages']]
+            document['codes'] = [extract_fault_codes(text) for text in texts]
+            return 'embed', document, texts
                 
-                # Only index files with reasonable content
-                if len(content.strip()) > 10:  # At least 10 characters of content
-                    relative_path = str(file_path.relative_to(base_path))
-                    self.file_contents[relative_path] = content
-                    
-                    # Create embedding for the file content
-                    print(f"   📄 Indexing: {relative_path}")
-                    embedding = self.get_embedding(content[:4000])  # Limit content for embedding
-                    self.document_embeddings[relative_path] = {
-                        'embedding': embedding,
-                        'content': content
-                    }
-                    
+        except Exception as e:
+            print(f"   ✗ Error indexing {file_path}: {e}")
+            return 'skip', None, []
+
+    def _index_pipeline(self, candidates: Iterator[Tuple[str, Path]], previous: DocumentIndex):
+        """
+        Check, read and embed candidate files as a streaming pipeline:
+
+            discovery thread -> path queue -> reader threads -> document queue -> embedding stage
+
+        Readers stat, hash and split files while up to embed_concurrency
+        /api/embed requests are in flight, so neither the CPU nor Ollama waits
+        on the other. Both queues are bounded, which keeps memory flat however
+        large the library is.
+
+        Args:
+            candidates (Iterator[Tuple[str, Path]]): (relative path, file path) of the files to check
+            previous (DocumentIndex): Index whose manifest and embeddings are reused
+
+        Returns:
+            Tuple: checked documents to keep, {path: (unit rows, norms, texts)} of the newly
+                embedded ones, {'added': [...], 'changed': [...]}, and whether any stored
+                document was touched
+        """
+        progress = self.index_progress
+        progress.update(files_checked=0, files_total=0, passages_embedded=0, passages_total=0)
+        path_queue = queue.Queue(self.index_queue_size)
+        document_queue = queue.Queue(self.index_queue_size)
+        finished = object()
+        discovery_errors = []
+        # Set when the embedding stage gives up, so the threads feeding it stop instead of blocking on full queues
+        stop = threading.Event()
+
+        def put(target: queue.Queue, item) -> bool:
+            while not stop.is_set():
+                try:
+                    target.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def discover():
+            try:
+                for item in candidates:
+                    progress['files_total'] += 1
+                    if not put(path_queue, item):
+                        return
             except Exception as e:
-                print(f"   ✗ Error indexing {file_path}: {e}")
+                discovery_errors.append(e)
+            finally:
+                for _ in range(self.index_readers):
+                    put(path_queue, finished)
+
+        def read():
+            while not stop.is_set():
+                try:
+                    item = path_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if item is finished:
+                    put(document_queue, finished)
+                    return
+                relative_path, file_path = item
+                stored = previous.lookup(relative_path)
+                try:
+                    prepared = self._prepare_document(relative_path, file_path, stored)
+                except Exception as e:
+                    print(f"   ✗ Could not read {relative_path}: {e}")
+                    prepared = ('skip', None, [])
+                if not put(document_queue, prepared + (stored,)):
+                    return
+
+        documents = []
+        fresh = {}
+        changes = {'added': [], 'changed': []}
+        touched = False
+        pending = {}  # path -> [document, stored, texts, vectors, passages still to embed]
+        batch = []
+        batch_bytes = 0
+        in_flight = deque()
+        embedded_documents = 0
+
+        def complete(document, stored, texts, vectors):
+            nonlocal embedded_documents
+            if vectors and all(vector is not None for vector in vectors):
+                file_vectors = [normalize_vector(vector) for vector in vectors]
+                file_norms = np.array([norm for _, norm in file_vectors], dtype=np.float32)
+                fresh[document['path']] = (np.vstack([vector for vector, _ in file_vectors]), file_norms, texts)
+                documents.append(document)
+                changes['added' if stored is None else 'changed'].append(document['path'])
+                self.needs_reembedding.discard(document['path'])
+                embedded_documents += 1
+            else:
+                # Keep the old version (if any) searchable and queue the file for another try
+                print(f"   ✗ Skipping {document['path']}: no embedding, queued for re-embedding")
+                self.needs_reembedding.add(document['path'])
+                if stored is not None:
+                    documents.append(stored)
+
+        def collect(future, keys):
+            for (path, i), vector in zip(keys, future.result()):
+                entry = pending[path]
+                entry[3][i] = vector
+                entry[4] -= 1
+                if not entry[4]:
+                    del pending[path]
+                    complete(*entry[:4])
+            progress['passages_embedded'] += len(keys)
+
+        def submit():
+            nonlocal batch, batch_bytes
+            # Bounded in-flight requests: wait for the oldest one before sending another
+            while len(in_flight) >= self.embed_concurrency:
+                collect(*in_flight.popleft())
+            in_flight.append((pool.submit(self._embed_batch, [text for _, _, text in batch]),
+                              [(path, i) for path, i, _ in batch]))
+            batch = []
+            batch_bytes = 0
+
+        def log_throughput():
+            elapsed = time.perf_counter() - start
+            print(f"   🚚 {progress['files_checked']}/{progress['files_total']} files checked, "
+                  f"{embedded_documents} embedded ({embedded_documents / max(elapsed, 1e-9):.1f} docs/sec), "
+                  f"queues: paths {path_queue.qsize()}/{self.index_queue_size}, "
+                  f"documents {document_queue.qsize()}/{self.index_queue_size}, "
+                  f"embeds in flight {len(in_flight)}/{self.embed_concurrency}")
+
+        start = time.perf_counter()
+        last_log = start
+        threads = [threading.Thread(target=discover, name="index-discovery", daemon=True)]
+        threads += [threading.Thread(target=read, name=f"index-reader-{i}", daemon=True) for i in range(self.index_readers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            with ThreadPoolExecutor(self.embed_concurrency, thread_name_prefix="embed") as pool:
+                readers_left = self.index_readers
+                while readers_left:
+                    if time.perf_counter() - last_log >= self.index_log_interval:
+                        log_throughput()
+                        last_log = time.perf_counter()
+                    try:
+                        item = document_queue.get(timeout=self.index_log_interval)
+                    except queue.Empty:
+                        continue
+                    if item is finished:
+                        readers_left -= 1
+                        continue
+
+                    progress['files_checked'] += 1
+                    kind, document, texts, stored = item
+                    if kind == 'keep':
+                        documents.append(document)
+                    elif kind == 'touched':
+                        documents.append(document)
+                        touched = True
+                    elif kind == 'embed':
+                        print(f"   📄 Indexing: {document['path']} ({len(texts)} passages)")
+                        progress['passages_total'] += len(texts)
+                        pending[document['path']] = [document, stored, texts, [None] * len(texts), len(texts)]
+                        if not texts:
+                            complete(*pending.pop(document['path'])[:4])
+                        for i, text in enumerate(texts):
+                            text_bytes = len(text.encode('utf-8'))
+                            if batch and (len(batch) >= self.embed_batch_size or batch_bytes + text_bytes > self.embed_max_batch_bytes):
+                                submit()
+                            batch.append((document['path'], i, text))
+                            batch_bytes += text_bytes
+
+                if batch:
+                    submit()
+                while in_flight:
+                    collect(*in_flight.popleft())
+        except BaseException:
+            # Release the discovery and reader threads, then let the error end this run
+            stop.set()
+            for thread in threads:
+                thread.join()
+            raise
+
+        if discovery_errors:
+            # Files we never saw would look deleted; keep the previous index instead
+            raise RuntimeError(f"listing files failed: {discovery_errors[0]}")
+
+        if progress['passages_total']:
+            elapsed = time.perf_counter() - start
+            print(f"   ⚡ Embedded {embedded_documents} documents ({progress['passages_total']} passages) in {elapsed:.1f}s "
+                  f"({embedded_documents / max(elapsed, 1e-9):.1f} docs/sec, {progress['passages_total'] / max(elapsed, 1e-9):.1f} "
+                  f"passages/sec, {self.index_readers} readers, {self.embed_concurrency} embeds in flight)")
+        return documents, fresh, changes, touched
+
+    def start_background_indexing(self, directory_path: str = ".", paths: Optional[List[str]] = None) -> bool:
+        """
+        Build or refresh the index in a daemon thread. Questions keep being
+        answered from the published snapshot until the new one is swapped in.
         
-        print(f"✅ Indexed {len(self.document_embeddings)} documents")
-    
-    def find_relevant_documents(self, question: str, top_k: int = 3) -> List[Tuple[str, float, str]]:
+        Args:
+            directory_path (str): Path to directory to index
+            paths (Optional[List[str]]): Only re-check these files (see update_index)
+            
+        Returns:
+            bool: False if an indexing run is already in progress
         """
-        Find the most relevant documents for a question using semantic search.
+        with self._builder_lock:
+            if self.is_indexing():
+                return False
+            self.index_progress.update(state='indexing', started=time.time(), error=None)
+            self._builder = threading.Thread(target=self._build_index, args=(directory_path, paths),
+                                             name="index-builder", daemon=True)
+            self._builder.start()
+            return True
+
+    def _build_index(self, directory_path: str, paths: Optional[List[str]] = None) -> None:
+        """Body of the background indexing thread."""
+        progress = self.index_progress
+        first_build = not progress['ready']
+        try:
+            changes = self.update_index(directory_path, paths)
+        except Exception as e:
+            progress.update(state='failed', error=str(e))
+            print(f"✗ Indexing {directory_path} failed: {e}")
+            return
+
+        progress.update(state='ready', ready=True)
+        elapsed = time.time() - progress['started']
+        if first_build:
+            print(f"✅ Indexed {len(self.index.documents)} documents, {len(self.index)} passages in {elapsed:.1f}s "
+                  f"({len(changes['added'])} added, {len(changes['changed'])} changed, {len(changes['removed'])} removed)")
+        elif any(changes.values()):
+            print(f"🔄 Index updated: {len(changes['added'])} added, {len(changes['changed'])} changed, {len(changes['removed'])} removed")
+
+    def watch(self, directory_path: str = ".", interval: float = 2.0, debounce: float = 5.0) -> None:
+        """
+        Keep the index live: poll the directory for file changes and re-index
+        just the changed files once they settle.
         
         Args:
-            question (str): User question
-            top_k (int): Number of top documents to return
+            directory_path (str): Indexed directory to watch
+            interval (float): Seconds between polls
+            debounce (float): Seconds a file has to stay unchanged before it is re-indexed
+        """
+        if self.watcher is not None:
+            self.watcher.stop()
+        root = str(Path(directory_path).resolve())
+        self.watcher = DirectoryWatcher([root], lambda paths: self._on_files_changed(root, paths), interval, debounce)
+        self.watcher.start()
+
+    def _on_files_changed(self, root: str, paths: List[str]) -> None:
+        """Watcher callback: incremental update for the settled paths."""
+        if not self.is_ready():
+            # The first full build picks these files up; let it finish rather than
+            # publishing an index of just these few files
+            if self.is_indexing():
+                self._builder.join()
+            if not self.is_ready():
+                return
+        changes = self.update_index(root, paths)
+        if any(changes.values()):
+            print(f"👀 Index updated from watcher: {len(changes['added'])} added, "
+                  f"{len(changes['changed'])} changed, {len(changes['removed'])} removed")
+
+    def is_indexing(self) -> bool:
+        """Whether an indexing run is in progress."""
+        return self._builder is not None and self._builder.is_alive()
+
+    def is_ready(self) -> bool:
+        """Whether questions can be answered: an index has been built or loaded."""
+        return self.index_progress['ready'] or len(self.index) > 0
+
+    def status_report(self) -> str:
+        """Return readiness and progress of the index."""
+        index = self.index
+        progress = self.index_progress
+        lines = [f"Index: {'ready' if self.is_ready() else 'warming up'}, "
+                 f"{len(index.documents)} documents, {len(index)} passages"]
+        if self.is_indexing():
+            lines.append(f"Indexing for {time.time() - progress['started']:.0f}s: "
+                         f"{progress['files_checked']}/{progress['files_total']} files checked, "
+                         f"{progress['passages_embedded']}/{progress['passages_total']} passages embedded")
+        elif progress['state'] == 'failed':
+            lines.append(f"Last indexing run failed: {progress['error']}")
+        if self.needs_reembedding or self.embedding_breaker.state != 'closed':
+            lines.append(f"{len(self.needs_reembedding)} files waiting to be re-embedded, "
+                         f"{self.backend.name} embeddings circuit {self.embedding_breaker.state}")
+        return "\n".join(lines)
+
+    def read_passage(self, path: str, offset: int, length: int) -> Optional[str]:
+        """
+        Return the text of a passage.
+
+        If the file was rewritten since it was indexed, the stored offsets no
+        longer point at the passage: it is skipped and the file is queued for
+        re-indexing.
+        
+        Args:
+            path (str): Document path relative to the indexed directory
+            offset (int): Byte offset of the passage
+            length (int): Byte length of the passage
             
         Returns:
-            List[Tuple[str, float, str]]: List of (filename, similarity_score, content) tuples
+            Optional[str]: Decoded passage text, None if the file changed since it was indexed
+        """
+        index = self.index
+        document = index.lookup(path)
+        if document is None:
+            return self.passages.read(Path(index.root) / path, offset, length)
+        text = self.passages.read(Path(index.root) / path, offset, length, document['size'], document['mtime_ns'])
+        if text is None:
+            if path not in self.stale_files:
+                print(f"   ✗ {path} changed since it was indexed, skipping its passages until it is re-indexed")
+                self.stale_files.add(path)
+            self.start_background_indexing(index.root, sorted(self.stale_files))
+        return text
+
+    def _read_passages(self, ranked: List[Tuple[str, int, int, float]]) -> List[Tuple[str, int, float, str]]:
+        """(filename, offset, score, passage) of ranked passages, leaving out those of changed files."""
+        found = [(filename, offset, score, self.read_passage(filename, offset, length))
+                 for filename, offset, length, score in ranked]
+        return [passage for passage in found if passage[3] is not None]
+    
+    def _train_ann(self, index: DocumentIndex) -> Optional[DocumentIndex]:
         """
-        if not self.document_embeddings:
+        (Re)train the IVF lists of an index that is about to be published, when
+        ANN search is on and the index has no lists yet or has doubled in size
+        since they were trained. The index may be the one readers are searching,
+        so the lists go into a copy.
+
+        Returns:
+            Optional[DocumentIndex]: The index with its new lists, None if no training was due
+        """
+        if not self.ann or len(index) < self.ann_min_passages:
+            return None
+        if index.ivf is not None and len(index) <= 2 * index.ivf.trained_size:
+            return None
+        
+        start = time.perf_counter()
+        ivf = IVFIndex.train(index.embeddings)
+        print(f"   🧭 Trained ANN index: {len(ivf.centroids)} lists over {len(index)} passages "
+              f"in {time.perf_counter() - start:.1f}s")
+        return index.with_ivf(ivf)
+    
+    def _search(self, question: str, top_k: int, shard: Optional[str] = None) -> List[Tuple[str, int, int, float]]:
+        """
+        Return (filename, byte_offset, byte_length, score) of the best passages.
+
+        A pinned shard restricts every stage to that directory. Otherwise the
+        embedding search only scans the route_shards shards closest to the
+        question, while BM25 still sees the whole library so an exact part
+        number is found wherever it lives.
+        """
+        if not len(self.index):
             return []
+        return self._rank(question, self.get_embedding(question), top_k, shard)
+
+    def _rank(self, question: str, question_embedding, top_k: int,
+              shard: Optional[str] = None) -> List[Tuple[str, int, int, float]]:
+        """_search for an already embedded question."""
+        index = self.index
+        if not len(index):
+            return []
+        pinned = [shard] if shard else None
         
-        print("🔍 Finding relevant documents...")
-        question_embedding = self.get_embedding(question)
+        # Fault codes in the question resolve to their passages by dictionary lookup,
+        # only those passages get scored
+        codes = [code for code in extract_fault_codes(question, ignore_case=True) if code in index.fault_codes]
+        if codes:
+            if question_embedding is None:
+                rows = index.fault_code_rows(codes)
+                if pinned:
+                    rows = rows[index.shard_mask(pinned)[rows]]
+                ranked = [(int(row), 1.0) for row in rows[:top_k]]
+            else:
+                ranked = index.search(question_embedding, top_k, index.fault_code_rows(codes), shards=pinned)
+            if ranked:
+                return [index.passage(row) + (score,) for row, score in ranked]
+        
+        if question_embedding is None:
+            # Ollama couldn't embed the question; keyword search still finds exact terms
+            print("⚠️ No question embedding, searching keywords only")
+            allowed = index.shard_mask(pinned) if pinned else None
+            return [index.passage(row) + (score,) for row, score in index.lexical.search(question, top_k, allowed=allowed)]
+        
+        shards = pinned
+        if shards is None and self.route_shards:
+            shards = index.route(question_embedding, self.route_shards)
+            if len(shards) < len(index.shard_names):
+                print(f"🧭 Searching shards: {', '.join(shards)}")
         
-        # Calculate similarity scores
-        similarities = []
-        for filename, doc_data in self.document_embeddings.items():
-            similarity = self.cosine_similarity(question_embedding, doc_data['embedding'])
-            similarities.append((filename, similarity, doc_data['content']))
+        # One matrix-vector product over the pre-normalized rows of the chosen
+        # shards (or their probed IVF lists), top_k via argpartition
+        nprobe = self.nprobe if self.ann else 0
+        if self.hybrid_search:
+            # Exact terms like part numbers come from BM25, paraphrases from embeddings
+            candidates = top_k * 4
+            allowed = index.shard_mask(pinned) if pinned else None
+            ranked = reciprocal_rank_fusion([index.search(question_embedding, candidates, nprobe=nprobe, shards=shards),
+                                             index.lexical.search(question, candidates, allowed=allowed)], top_k)
+        else:
+            ranked = index.search(question_embedding, top_k, nprobe=nprobe, shards=shards)
+        return [index.passage(row) + (score,) for row, score in ranked]
+    
+    def lookup_fault_code(self, code: str) -> List[Tuple[str, int]]:
+        """
+        Find every passage mentioning a fault code.
         
-        # Sort by similarity and return top_k
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        return similarities[:top_k]
+        Args:
+            code (str): Fault code, in any case or spacing
+            
+        Returns:
+            List[Tuple[str, int]]: List of (filename, byte_offset) tuples
+        """
+        index = self.index
+        rows = index.fault_code_rows([normalize_fault_code(code)])
+        return [index.passage(row)[:2] for row in rows]
+    
+    def search_passages(self, question: str, top_k: int = 5, shard: Optional[str] = None) -> List[Tuple[str, int, float]]:
+        """
+        Find the passages most similar to a question.
+        
+        Args:
+            question (str): User question
+            top_k (int): Number of passages to return
+            shard (str): Only search this top-level directory
+            
+        Returns:
+            List[Tuple[str, int, float]]: List of (filename, byte_offset, score) tuples; the score is
+                the fused reciprocal-rank score with hybrid_search, the cosine similarity otherwise
+        """
+        return [(filename, offset, score) for filename, offset, _, score in self._search(question, top_k, shard)]
+    
+    def find_relevant_documents(self, question: str, top_k: int = 5,
+                                shard: Optional[str] = None) -> List[Tuple[str, int, float, str]]:
+        """
+        Find the most relevant passages for a question using semantic (and BM25) search.
+        
+        Args:
+            question (str): User question
+            top_k (int): Number of top passages to return
+            shard (str): Only search this top-level directory
+            
+        Returns:
+            List[Tuple[str, int, float, str]]: List of (filename, byte_offset, score, passage) tuples
+        """
+        print("🔍 Finding relevant documents...")
+        return self._read_passages(self._search(question, top_k, shard))
     
     def ask_ollama_question(self, question: str, context: str) -> str:
         """
@@ -188,96 +974,584 @@ class OllamaDocumentQA:
             str: Answer from Ollama
         """
         try:
-            prompt = f"""Based on the following documents, please answer the user's question.
+            start = time.perf_counter()
+            result = self.backend.generate(self._answer_prompt(question, context), timeout=60)
+            self._log_generation_latency(time.perf_counter() - start, result)
+            return result["response"]
+            
+        except Exception as e:
+            return f"Error asking {self.backend.name}: {str(e)}"
+
+    async def _generate_async(self, prompt: str, **options) -> Dict:
+        """Run one generation over the backend and log its latency; returns the whole response."""
+        start = time.perf_counter()
+        response = await self.backend.generate_async(prompt, **options)
+        self._log_generation_latency(time.perf_counter() - start, response)
+        return response
+
+    async def _generate_stream(self, prompt: str, final: Dict, **options) -> AsyncIterator[str]:
+        """
+        Stream one generation over the backend, logging time to first token and
+        latency. The last chunk (with the context and token counts) is copied into `final`.
+        """
+        start = time.perf_counter()
+        first_token = True
+        async for chunk in self.backend.generate_stream(prompt, **options):
+            piece = chunk.get("response", "")
+            if piece:
+                if first_token:
+                    print(f"⏱️ First token after {time.perf_counter() - start:.2f}s")
+                    first_token = False
+                yield piece
+            if chunk.get("done"):
+                final.update(chunk)
+        self._log_generation_latency(time.perf_counter() - start, final, "Answer streamed")
+
+    async def get_embedding_async(self, text: str) -> Optional[List[float]]:
+        """Async get_embedding over the pooled client."""
+        try:
+            return (await self._request_embeddings_async(text))[0]
+        except Exception as e:
+            print(f"Error getting embedding: {e}")
+            return None
+
+    def _log_generation_latency(self, seconds: float, response: Dict, label: str = "Answer generated") -> None:
+        """Log and count a generation as cold (the model had to be loaded) or warm."""
+        load_seconds = response.get("load_duration", 0) / 1e9
+        kind = 'cold' if load_seconds >= COLD_LOAD_SECONDS else 'warm'
+        self.latency_stats[kind]['answers'] += 1
+        self.latency_stats[kind]['seconds'] += seconds
+        detail = f", {load_seconds:.1f}s loading the model" if kind == 'cold' else ""
+        print(f"⏱️ {label} in {seconds:.2f}s ({kind}{detail})")
+
+    def latency_report(self) -> str:
+        """Return average answer latency with a cold versus a warm model."""
+        parts = []
+        for kind in ('warm', 'cold'):
+            stats = self.latency_stats[kind]
+            average = stats['seconds'] / stats['answers'] if stats['answers'] else 0.0
+            parts.append(f"{stats['answers']} {kind} (avg {average:.1f}s)")
+        keep_alive = f"; keep_alive {self.keep_alive}" if self.keep_alive is not None else ""
+        return f"Answers: {', '.join(parts)}{keep_alive}"
+
+    def warm_up(self) -> None:
+        """
+        Load the embedding and generation models into Ollama with keep_alive,
+        so the next question doesn't pay for loading them.
+        """
+        for model in (self.embedding_model, self.generation_model):
+            start = time.perf_counter()
+            try:
+                load_seconds = self.backend.preload(model)
+                state = f"cold, {load_seconds:.1f}s loading" if load_seconds >= COLD_LOAD_SECONDS else "already warm"
+                print(f"🔥 {model} ready in {time.perf_counter() - start:.2f}s ({state})")
+            except Exception as e:
+                print(f"✗ Warming up {model} failed: {e}")
+
+    def in_business_hours(self, now: datetime = None) -> bool:
+        """Whether models should be kept warm at this (local) time."""
+        now = now or datetime.now()
+        start_hour, end_hour = self.business_hours
+        return now.weekday() in self.business_days and start_hour <= now.hour < end_hour
+
+    def start_keep_warm(self) -> None:
+        """
+        Warm the models up now, then ping them every keep_warm_interval seconds
+        during business hours so Ollama doesn't evict them between questions.
+        """
+        if self._keep_warm is not None and self._keep_warm.is_alive():
+            return
+        self._keep_warm_stop.clear()
+        self._keep_warm = threading.Thread(target=self._keep_warm_loop, name="keep-warm", daemon=True)
+        self._keep_warm.start()
+
+    def stop_keep_warm(self) -> None:
+        """Stop the keep-warm pings."""
+        self._keep_warm_stop.set()
+
+    def _keep_warm_loop(self) -> None:
+        self.warm_up()
+        while not self._keep_warm_stop.wait(self.keep_warm_interval):
+            if self.in_business_hours():
+                self.warm_up()
+
+    def _answer_prompt(self, question: str, context: str, history: str = "") -> str:
+        """Prompt asking the generation model to answer from the given passages (and conversation so far)."""
+        conversation = f"""CONVERSATION SO FAR:
+{history}
 
-DOCUMENTS:
+""" if history else ""
+        return f"""Based on the following documents, please answer the user's question.
+
+{conversation}DOCUMENTS:
 {context}
 
 USER QUESTION: {question}
 
 Please provide a comprehensive answer based on the document contents. 
 If the answer cannot be found in the documents, please state that clearly.
+Be specific and cite which documents contain the relevant information."""
+    
+    def _follow_up_prompt(self, question: str, context: str) -> str:
+        """
+        Prompt continuing a conversation: the documents sent earlier are
+        already in the model's context, only passages it hasn't seen are added.
+        """
+        documents = f"""MORE DOCUMENTS:
+{context}
+
+""" if context else ""
+        return f"""{documents}FOLLOW-UP QUESTION: {question}
+
+Answer from the documents of this conversation. If the answer cannot be found in them, please state that clearly.
 Be specific and cite which documents contain the relevant information."""
 
-            response = requests.post(
-                f"{self.ollama_base_url}/api/generate",
-                json={
-                    "model": "gemma2:2b",  # You can change this to any model you have
-                    "prompt": prompt,
-                    "stream": False
-                },
-                timeout=60
-            )
-            response.raise_for_status()
-            return response.json()["response"]
-            
+    def _conversation_prompt(self, chat, question: str,
+                             relevant_docs: List[Tuple[str, int, float, str]]) -> Tuple[str, Dict]:
+        """
+        Prompt and generation options for a question asked in a chat. A
+        follow-up passes the model's context tokens back, so the conversation
+        so far comes from Ollama's cache instead of being re-sent and re-read.
+        
+        Returns:
+            Tuple[str, Dict]: The prompt and extra generation options
+        """
+        conversation = self.conversations.get(chat) if chat is not None else None
+        if conversation is None:
+            return self._answer_prompt(question, self._build_context(relevant_docs)), {}
+        
+        context_tokens = self.conversations.reusable_context(conversation)
+        if context_tokens is None:
+            # Nothing to continue from (the backend has no context, or it grew too long):
+            # the summary and recent turns ride along in a fresh prompt instead
+            history = conversation.transcript()
+            print(f"💬 Question #{conversation.turns + 1} in chat {chat}, with {count_tokens(history)} tokens of history")
+            return self._answer_prompt(question, self._build_context(relevant_docs), history), {}
+        
+        new_docs = [doc for doc in relevant_docs if (doc[0], doc[1]) not in conversation.passages]
+        print(f"💬 Follow-up #{conversation.turns} in chat {chat}: "
+              f"{len(relevant_docs) - len(new_docs)} of {len(relevant_docs)} passages already in the context")
+        context = self._build_context(new_docs) if new_docs else ""
+        return self._follow_up_prompt(question, context), {"context": context_tokens}
+
+    def _remember_turn(self, chat, question: str, answer: str, relevant_docs: List[Tuple[str, int, float, str]],
+                       response: Dict, continued: bool) -> None:
+        """
+        Keep an answer (and its context tokens) for the chat's next question,
+        and start summarizing the history if it went over budget.
+        """
+        if chat is None:
+            return
+        self.conversations.remember(chat, question, answer, response.get("context"),
+                                    [(doc[0], doc[1]) for doc in relevant_docs], continued,
+                                    response.get("prompt_eval_count", 0))
+        taken = self.conversations.take_for_summary(chat)
+        if taken is not None:
+            # In the background: the answer has been given, nobody should wait for this
+            task = asyncio.ensure_future(self._summarize_history(chat, *taken))
+            self._summaries.add(task)
+            task.add_done_callback(self._summaries.discard)
+
+    def _remember_shared_turn(self, chat, question: str, turn: Optional[AnsweredTurn]) -> None:
+        """
+        Record a coalesced answer in the conversation of a chat that joined the
+        flight, once per chat. The chat the answer was generated for has
+        already recorded it.
+        """
+        if turn is None or chat is None or chat in turn.chats:
+            return
+        turn.chats.add(chat)
+        # Joined flights are never follow-ups (see _conversation_scope), so the
+        # answer starts this chat's context, just as it did for the first chat
+        self._remember_turn(chat, question, turn.answer, turn.relevant_docs, turn.response, False)
+
+    async def _share_turns(self, fragments: AsyncIterator, question: str, chat) -> AsyncIterator[str]:
+        """A caller's view of a (possibly shared) answer stream, recording the answered turn for its chat."""
+        async for fragment in fragments:
+            if isinstance(fragment, AnsweredTurn):
+                self._remember_shared_turn(chat, question, fragment)
+            else:
+                yield fragment
+
+    def _summary_prompt(self, summary: str, turns: List[Dict[str, str]]) -> str:
+        """Prompt folding older turns of a conversation into its running summary."""
+        earlier = f"""EARLIER SUMMARY:
+{summary}
+
+""" if summary else ""
+        return f"""Summarize this troubleshooting conversation between a user and an assistant answering from technical manuals, so the assistant can continue it.
+Keep machine and controller models, fault codes, steps already tried and their outcomes, and open questions. Leave out pleasantries.
+Reply with the summary only, in at most {self.conversations.history_budget // 4} words.
+
+{earlier}CONVERSATION:
+{format_turns(turns)}"""
+
+    async def _summarize_history(self, chat, summary: str, turns: List[Dict[str, str]]) -> None:
+        """Fold the given oldest turns of a chat into its summary."""
+        new_summary = None
+        try:
+            # Summaries are generations too and queue like answers
+            async with self.scheduler.slot(chat):
+                response = await self.backend.generate_async(self._summary_prompt(summary, turns),
+                                                             max_tokens=self.conversations.history_budget // 3,
+                                                             temperature=0.2)
+            new_summary = response["response"].strip() or None
+            if new_summary:
+                print(f"🗜️ Folded {len(turns) // 2} turns of chat {chat} into a {count_tokens(new_summary)}-token summary")
         except Exception as e:
-            return f"Error asking Ollama: {str(e)}"
+            print(f"✗ Summarizing the conversation of chat {chat} failed: {e}")
+        finally:
+            self.conversations.finish_summary(chat, new_summary, turns)
+
+    def _conversation_scope(self, chat, shard: Optional[str]):
+        """Coalescing scope of a question: a follow-up depends on its chat's conversation."""
+        if chat is not None and self.conversations.get(chat) is not None:
+            return shard, chat
+        return shard
+
+    def _fast_path_answer(self, question: str, shard: Optional[str] = None) -> str:
+        """
+        Answer a question that is just a fault code lookup straight from the index.
+        
+        Args:
+            question (str): User question
+            shard (str): Only answer from this top-level directory
+            
+        Returns:
+            str: Answer with the matching passage and its source, or None if the
+                question needs the LLM
+        """
+        codes = extract_fault_codes(question, ignore_case=True)
+        if not codes:
+            return None
+        self.fast_path_stats['questions'] += 1
+        
+        # The question has to be about the code and not much else
+        extra_words = [word for word in tokenize(question)
+                       if word not in FAST_PATH_FILLER_WORDS and normalize_fault_code(word) not in codes]
+        if len(extra_words) > self.fast_path_max_extra_words:
+            return None
+        
+        # ... and the code has to point at a handful of passages, not be all over the manuals
+        index = self.index
+        rows = index.fault_code_rows(codes)
+        if shard:
+            rows = rows[index.shard_mask([shard])[rows]]
+        if not len(rows) or len(rows) > self.fast_path_max_hits:
+            return None
+        
+        passages = []
+        texts = []
+        for filename, offset, length in (index.passage(row) for row in rows):
+            text = self.read_passage(filename, offset, length)
+            if text is not None:
+                passages.append((filename, offset, length))
+                texts.append(text)
+        if not texts:
+            return None
+        best = max(range(len(texts)), key=lambda i: sum(normalize_fault_code(word) in codes for word in texts[i].split()))
+        filename, offset, _ = passages[best]
+        
+        return (f"🔎 {', '.join(codes)} (straight from the documents):\n\n{texts[best].strip()}"
+                f"\n\n📚 Source: {filename} @ {offset}")
     
-    def ask_about_documents(self, user_question: str, directory_path: str = ".") -> str:
+    def fast_path_report(self) -> str:
+        """Return hit-rate and latency counters of the fault-code fast path."""
+        stats = self.fast_path_stats
+        hit_rate = stats['hits'] / stats['questions'] * 100 if stats['questions'] else 0.0
+        hit_ms = stats['hit_seconds'] / stats['hits'] * 1000 if stats['hits'] else 0.0
+        llm_ms = stats['llm_seconds'] / stats['llm_answers'] * 1000 if stats['llm_answers'] else 0.0
+        return (f"Fast path: {'on' if self.fast_path else 'off'}\n"
+                f"Fault-code questions: {stats['questions']}, answered from the index: {stats['hits']} ({hit_rate:.0f}%)\n"
+                f"Avg latency: {hit_ms:.1f} ms from the index, {llm_ms:.0f} ms with the LLM ({stats['llm_answers']} answers)")
+    
+    def _early_answer(self, user_question: str, directory_path: str, shard: Optional[str]) -> Optional[str]:
+        """
+        Reply that doesn't need retrieval and generation: warming up, an empty
+        library or a fault-code fast-path hit. Also kicks off index refreshes.
+        """
+        # Indexing runs in the background; until the first index is published there is nothing to search
+        if not self.is_ready():
+            self.start_background_indexing(directory_path)
+            return "⏳ Warming up, the documents are still being indexed. Please ask again in a minute.\n\n" + self.status_report()
+        
+        # Pick up new or changed files without making this question wait for them
+        if time.monotonic() - self._last_update >= self.refresh_interval:
+            self.start_background_indexing(self.index.root or directory_path)
+        elif self.needs_reembedding and self.embedding_breaker.state != 'open':
+            # Ollama may be back: retry the files whose embedding failed
+            self.start_background_indexing(self.index.root or directory_path, sorted(self.needs_reembedding))
+        elif self.stale_files:
+            # Rewritten files found while reading passages, if the builder was busy back then
+            self.start_background_indexing(self.index.root or directory_path, sorted(self.stale_files))
+        
+        if not len(self.index):
+            if self.needs_reembedding:
+                return (f"⚠️ The documents couldn't be embedded yet, is {self.backend.name} reachable? "
+                        "They are retried in the background.\n\n" + self.status_report())
+            return "No documents were found to index in the directory."
+        
+        # Plain fault code questions skip the embedding call and the LLM
+        if self.fast_path:
+            start = time.perf_counter()
+            answer = self._fast_path_answer(user_question, shard)
+            if answer is not None:
+                self.fast_path_stats['hits'] += 1
+                self.fast_path_stats['hit_seconds'] += time.perf_counter() - start
+                print("⚡ Answered from the fault code index")
+                return answer
+        return None
+
+    def _build_context(self, relevant_docs: List[Tuple[str, int, float, str]]) -> str:
+        """Log the retrieved passages and join them into the prompt context."""
+        print(f"📑 Found {len(relevant_docs)} relevant passages:")
+        for i, (filename, offset, score, passage) in enumerate(relevant_docs):
+            print(f"   {i+1}. {filename} @ {offset} (score: {score:.3f})")
+        
+        # Prepare context from the relevant passages only
+        context_parts = []
+        for filename, offset, score, passage in relevant_docs:
+            context_parts.append(f"--- {filename} (relevance: {score:.3f}) ---\n{passage}")
+        
+        return "\n\n".join(context_parts)
+
+    def _finish_answer(self, answer: str, relevant_docs: List[Tuple[str, int, float, str]], start: float) -> str:
+        """Append the sources to a generated answer and count it."""
+        source_files = list(dict.fromkeys(filename for filename, _, _, _ in relevant_docs))
+        answer += f"\n\n📚 Sources: {', '.join(source_files)}"
+        
+        self.fast_path_stats['llm_answers'] += 1
+        self.fast_path_stats['llm_seconds'] += time.perf_counter() - start
+        return answer
+
+    def ask_about_documents(self, user_question: str, directory_path: str = ".", shard: Optional[str] = None) -> str:
         """
         Main function to answer questions about documents using Ollama embeddings.
         
         Args:
             user_question (str): User's question
             directory_path (str): Base directory path
+            shard (str): Only use documents of this top-level directory (e.g. one vendor)
             
         Returns:
             str: Answer to the user's question
         """
         try:
-            # Index documents if not already indexed
-            if not self.document_embeddings:
-                self.index_documents(directory_path)
-            
-            if not self.document_embeddings:
-                return "No documents were found to index in the directory."
+            answer = self._early_answer(user_question, directory_path, shard)
+            if answer is not None:
+                return answer
+            start = time.perf_counter()
             
             # Find relevant documents using semantic search
-            relevant_docs = self.find_relevant_documents(user_question)
+            relevant_docs = self.find_relevant_documents(user_question, shard=shard)
             
             if not relevant_docs:
                 return "No relevant documents found for your question."
             
-            print(f"📑 Found {len(relevant_docs)} relevant documents:")
-            for i, (filename, score, content) in enumerate(relevant_docs):
-                print(f"   {i+1}. {filename} (similarity: {score:.3f})")
-            
-            # Prepare context from relevant documents
-            context_parts = []
-            for filename, score, content in relevant_docs:
-                # Use truncated content to avoid token limits
-                truncated_content = content[:3000] + "..." if len(content) > 3000 else content
-                context_parts.append(f"--- {filename} (relevance: {score:.3f}) ---\n{truncated_content}")
-            
-            context = "\n\n".join(context_parts)
+            context = self._build_context(relevant_docs)
             
             # Ask Ollama with the context
             print("🤔 Generating answer...")
             answer = self.ask_ollama_question(user_question, context)
             
-            # Add source information
-            source_files = [filename for filename, _, _ in relevant_docs]
-            answer += f"\n\n📚 Sources: {', '.join(source_files)}"
+            return self._finish_answer(answer, relevant_docs, start)
+            
+        except Exception as e:
+            return f"Error processing your request: {str(e)}"
+
+    async def _find_relevant_documents_async(self, question: str, shard: Optional[str],
+                                             top_k: int = 5) -> List[Tuple[str, int, float, str]]:
+        """find_relevant_documents with the question embedded over the async client."""
+        print("🔍 Finding relevant documents...")
+        question_embedding = await self.get_embedding_async(question)
+        return self._read_passages(self._rank(question, question_embedding, top_k, shard))
+
+    def _busy_reply(self, error: QueueFull) -> str:
+        """Reply for a question turned away by a full generation queue."""
+        print(f"🚦 Generation queue full ({error.queued} waiting), turning a question away")
+        return f"🚦 Busy right now: {error.queued} questions are already waiting for an answer. Please ask again in a minute."
+
+    async def ask_about_documents_async(self, user_question: str, directory_path: str = ".",
+                                        shard: Optional[str] = None, chat=None,
+                                        on_queued: Callable[[int], Awaitable] = None) -> str:
+        """
+        ask_about_documents for asyncio callers such as the Telegram handlers.
+        
+        The embedding and generation requests are awaited over the pooled
+        keep-alive client, so a slow answer doesn't block the event loop; the
+        index search itself is in-memory and stays inline. With coalesce on,
+        a question asked while an identical one is in flight awaits that answer.
+        The generation waits for a slot of the scheduler. A question from a
+        chat with an ongoing conversation is answered as a follow-up, on top
+        of the context the model returned last time.
+        
+        Args:
+            user_question (str): User's question
+            directory_path (str): Base directory path
+            shard (str): Only use documents of this top-level directory (e.g. one vendor)
+            chat: Who is asking, for fair turns between chats in the generation queue
+                and for the conversation a follow-up continues
+            on_queued (Callable[[int], Awaitable]): Awaited with the place in line if
+                the generation has to wait
             
+        Returns:
+            str: Answer to the user's question
+        """
+        if not self.coalesce:
+            answer, _ = await self._answer_async(user_question, directory_path, shard, chat, on_queued)
             return answer
+        answer, turn = await self.single_flight.do(
+            question_key(user_question, self._conversation_scope(chat, shard)),
+            lambda: self._answer_async(user_question, directory_path, shard, chat, on_queued))
+        self._remember_shared_turn(chat, user_question, turn)
+        return answer
+
+    async def _answer_async(self, user_question: str, directory_path: str, shard: Optional[str],
+                            chat, on_queued: Callable[[int], Awaitable]) -> Tuple[str, Optional[AnsweredTurn]]:
+        """ask_about_documents_async without coalescing; also returns the answered turn, if any."""
+        try:
+            answer = self._early_answer(user_question, directory_path, shard)
+            if answer is not None:
+                return answer, None
+            start = time.perf_counter()
+            
+            relevant_docs = await self._find_relevant_documents_async(user_question, shard)
+            
+            if not relevant_docs:
+                return "No relevant documents found for your question.", None
+            
+            prompt, options = self._conversation_prompt(chat, user_question, relevant_docs)
+            
+            try:
+                async with self.scheduler.slot(chat, on_queued):
+                    print("🤔 Generating answer...")
+                    response = await self._generate_async(prompt, **options)
+            except QueueFull as e:
+                return self._busy_reply(e), None
+            except Exception as e:
+                return f"Error asking {self.backend.name}: {str(e)}", None
+            
+            self._remember_turn(chat, user_question, response["response"], relevant_docs, response, "context" in options)
+            return (self._finish_answer(response["response"], relevant_docs, start),
+                    AnsweredTurn({chat}, response["response"], relevant_docs, response))
             
         except Exception as e:
-            return f"Error processing your request: {str(e)}"
+            return f"Error processing your request: {str(e)}", None
+
+    def ask_about_documents_stream(self, user_question: str, directory_path: str = ".",
+                                   shard: Optional[str] = None, chat=None,
+                                   on_queued: Callable[[int], Awaitable] = None) -> AsyncIterator[str]:
+        """
+        Streaming ask_about_documents: yields fragments that concatenate to the
+        same answer, starting as soon as the model emits its first token. With
+        coalesce on, a question asked while an identical one is streaming
+        follows that stream (from its start) instead of generating again.
+        The generation waits for a slot of the scheduler. Questions from a chat
+        with an ongoing conversation are follow-ups, as in
+        ask_about_documents_async. Call from inside the running event loop.
+        
+        Args:
+            user_question (str): User's question
+            directory_path (str): Base directory path
+            shard (str): Only use documents of this top-level directory (e.g. one vendor)
+            chat: Who is asking, for fair turns between chats in the generation queue
+                and for the conversation a follow-up continues
+            on_queued (Callable[[int], Awaitable]): Awaited with the place in line if
+                the generation has to wait
+            
+        Returns:
+            AsyncIterator[str]: Answer text fragments, the sources line last
+        """
+        if not self.coalesce:
+            fragments = self._answer_stream(user_question, directory_path, shard, chat, on_queued)
+        else:
+            fragments = self.single_flight.stream(
+                question_key(user_question, self._conversation_scope(chat, shard)),
+                lambda: self._answer_stream(user_question, directory_path, shard, chat, on_queued))
+        return self._share_turns(fragments, user_question, chat)
+
+    async def _answer_stream(self, user_question: str, directory_path: str, shard: Optional[str],
+                             chat, on_queued: Callable[[int], Awaitable]) -> AsyncIterator:
+        """
+        ask_about_documents_stream without coalescing. Besides the text
+        fragments it yields the AnsweredTurn once the answer is complete.
+        """
+        try:
+            answer = self._early_answer(user_question, directory_path, shard)
+            if answer is not None:
+                yield answer
+                return
+            start = time.perf_counter()
+            
+            relevant_docs = await self._find_relevant_documents_async(user_question, shard)
+            
+            if not relevant_docs:
+                yield "No relevant documents found for your question."
+                return
+            
+            prompt, options = self._conversation_prompt(chat, user_question, relevant_docs)
+            final = {}
+            pieces = []
+            
+            try:
+                async with self.scheduler.slot(chat, on_queued):
+                    print("🤔 Streaming answer...")
+                    async for piece in self._generate_stream(prompt, final, **options):
+                        pieces.append(piece)
+                        yield piece
+            except QueueFull as e:
+                yield self._busy_reply(e)
+                return
+            except Exception as e:
+                # Like the non-streaming path: no sources and no answer statistics for a failed generation
+                yield f"Error asking {self.backend.name}: {str(e)}"
+                return
+            else:
+                self._remember_turn(chat, user_question, "".join(pieces), relevant_docs, final, "context" in options)
+                yield AnsweredTurn({chat}, "".join(pieces), relevant_docs, final)
+            
+            yield self._finish_answer("", relevant_docs, start)
+            
+        except Exception as e:
+            yield f"Error processing your request: {str(e)}"
 
 qa_system = OllamaDocumentQA(ollama_base_url="http://localhost:11434")
 
 
 
-def setup_ollama_qa(directory_path: str = "./data/"):    
+def setup_ollama_qa(directory_path: str = "./data/", background: bool = True, watch: bool = True,
+                    warm_up: bool = True):    
     qa_system.set_directory(directory_path)
 
-    qa_system.index_documents(directory_path)
-    print("\n🔧 Indexing documents (this may take a while)...")
+    if warm_up:
+        # Preload both models while the index is built, keep them resident during business hours
+        qa_system.start_keep_warm()
+
+    if watch:
+        qa_system.watch(directory_path)
 
-def ask_ollama_qa(user_question: str = "", directory_path = "./data/"):
-    answer = qa_system.ask_about_documents(user_question, directory_path)
+    if background:
+        qa_system.start_background_indexing(directory_path)
+        print("\n🔧 Indexing documents in the background, questions get a warming-up reply until it is done...")
+    else:
+        qa_system.index_documents(directory_path)
+
+def ask_ollama_qa(user_question: str = "", directory_path = "./data/", shard: str = None):
+    answer = qa_system.ask_about_documents(user_question, directory_path, shard)
     return answer
+
+async def ask_ollama_qa_async(user_question: str = "", directory_path = "./data/", shard: str = None, chat = None, on_queued = None):
+    answer = await qa_system.ask_about_documents_async(user_question, directory_path, shard, chat, on_queued)
+    return answer
+
+def ask_ollama_qa_stream(user_question: str = "", directory_path = "./data/", shard: str = None, chat = None, on_queued = None):
+    return qa_system.ask_about_documents_stream(user_question, directory_path, shard, chat, on_queued)
+
+def clear_conversation(chat) -> bool:
+    return qa_system.conversations.clear(chat)
+
+async def close_ollama_qa():
+    await qa_system.backend.aclose()
     
 
 # # Example usage
@@ -73,37 +73,57 @@ def process_text_to_chunks(text, chunk_size=60000):
     
     return chunks
 
-def process_pdf_to_chunks(pdf_path, chunk_size=60000):
+def process_pdf_to_chunks(pdf_path, chunk_size=60000, progress=None):
     """
     Extract text from PDF, remove stopwords, and split into chunks of ~90k words.
     
+    Pages are extracted, tokenized and filtered one at a time and chunks are
+    yielded as soon as they fill up, so only the current page and chunk are
+    held in memory, however long the manual is.
+    
     Args:
         pdf_path (str): Path to the PDF file
         chunk_size (int): Number of words per chunk (default: 90,000)
+        progress (callable): Called with (pages done, page count) after every page
     
-    Returns:
-        list: List of text chunks
+    Yields:
+        str: Text chunks, in document order
     """
-    # Extract text from PDF
-    text = ""
+    stop_words = set(stopwords.words('english'))
+    tokenizer = nltk.WordPunctTokenizer()
+    chunk = []
+
     with open(pdf_path, 'rb') as file:
         pdf_reader = PyPDF2.PdfReader(file)
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-    
-    # Remove stopwords
-    stop_words = stopwords.words('english')
-    tokens = nltk.WordPunctTokenizer().tokenize(text)
+        page_count = len(pdf_reader.pages)
+        for page_number, page in enumerate(pdf_reader.pages, 1):
+            # Pages were joined with newlines before tokenizing, so no token spans two pages
+            for token in tokenizer.tokenize(page.extract_text()):
+                if token.isalnum() and token.lower() not in stop_words:
+                    chunk.append(token)
+                    if len(chunk) == chunk_size:
+                        yield ' '.join(chunk)
+                        chunk = []
+            if progress is not None:
+                progress(page_number, page_count)
 
-    filtered_words = [token for token in tokens if (token.lower() not in stop_words) and token.isalnum()]
+    if chunk:
+        yield ' '.join(chunk)
 
-    # Split into chunks
-    chunks = []
-    for i in range(0, len(filtered_words), chunk_size):
-        chunk = ' '.join(filtered_words[i:i + chunk_size])
-        chunks.append(chunk)
-    
-    return chunks
+def mark_last(items):
+    """
+    Yield (item, is_last) pairs, looking one item ahead, for loops over a
+    generator that need to treat the last item specially.
+    """
+    iterator = iter(items)
+    try:
+        current = next(iterator)
+    except StopIteration:
+        return
+    for upcoming in iterator:
+        yield current, False
+        current = upcoming
+    yield current, True
 
 def get_files_to_process():
     dir1 = '/home/pe4enushko/Documents/Literature/'
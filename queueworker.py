@@ -0,0 +1,257 @@
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Hashable, Optional
+from indexworker import tokenize
+
+
+def question_key(question: str, scope: Optional[str] = None) -> tuple:
+    """
+    Key under which identical questions are coalesced: the question's words,
+    lowercased and without punctuation, plus the scope it is asked in (the
+    pinned shard), since the same words asked in another scope get another answer.
+    """
+    return ' '.join(tokenize(question)), scope
+
+
+class _Broadcast:
+    """One async iterator replayed to every subscriber, pumped by its own task."""
+
+    def __init__(self, source: AsyncIterator):
+        self.items = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+        # A task of its own, so the stream keeps going for the others if the
+        # subscriber that started it goes away
+        self.task = asyncio.ensure_future(self._pump(source))
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _pump(self, source: AsyncIterator) -> None:
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator:
+        position = 0
+        while True:
+            while position < len(self.items):
+                yield self.items[position]
+                position += 1
+            if self.done:
+                break
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent requests: while a request for a key is in
+    flight, further requests for that key wait for its result instead of
+    starting their own. Once it completes the key is released, so later
+    requests run fresh.
+
+    Call from inside the running event loop.
+    """
+
+    def __init__(self):
+        # requests: calls made, flights: calls actually executed, coalesced: calls that joined a flight
+        self.stats = {'requests': 0, 'flights': 0, 'coalesced': 0}
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self._streams: Dict[Hashable, _Broadcast] = {}
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable]):
+        """
+        Await call() once per key in flight.
+
+        Args:
+            key (Hashable): Identity of the request
+            call (Callable[[], Awaitable]): Starts the request; only invoked by the first caller
+
+        Returns:
+            The shared result (or raises the shared exception)
+        """
+        self.stats['requests'] += 1
+        future = self._calls.get(key)
+        if future is None:
+            self.stats['flights'] += 1
+            future = asyncio.ensure_future(call())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._release(self._calls, key, done))
+        else:
+            self.stats['coalesced'] += 1
+        # A caller that gets cancelled mustn't cancel the flight the others are waiting on
+        return await asyncio.shield(future)
+
+    def stream(self, key: Hashable, source: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """
+        Share one async stream per key in flight. A caller that joins late
+        first gets everything produced so far, then follows along live.
+
+        Args:
+            key (Hashable): Identity of the request
+            source (Callable[[], AsyncIterator]): Starts the stream; only invoked by the first caller
+
+        Returns:
+            AsyncIterator: This caller's view of the shared stream
+        """
+        self.stats['requests'] += 1
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            self.stats['flights'] += 1
+            broadcast = _Broadcast(source())
+            self._streams[key] = broadcast
+            broadcast.task.add_done_callback(lambda _: self._release(self._streams, key, broadcast))
+        else:
+            self.stats['coalesced'] += 1
+        return broadcast.subscribe()
+
+    @staticmethod
+    def _release(flights: Dict, key: Hashable, flight) -> None:
+        if flights.get(key) is flight:
+            del flights[key]
+
+    def report(self) -> str:
+        """Return how many requests were answered by joining another one."""
+        stats = self.stats
+        # A joined flight may have been answered without the LLM (fast path, warming up),
+        # so joins are reported as answers shared, not generations saved
+        return (f"Coalescing: {stats['requests']} questions, {stats['flights']} answered from scratch, "
+                f"{stats['coalesced']} shared the answer of an identical question in flight")
+
+
+class QueueFull(Exception):
+    """Raised by GenerationScheduler.slot when the wait queue is at its limit."""
+
+    def __init__(self, queued: int):
+        super().__init__(f"{queued} requests already waiting")
+        self.queued = queued
+
+
+class GenerationScheduler:
+    """
+    Bounds how many LLM generations run at once and shares the wait fairly.
+
+    At most `workers` slots are held at a time. Requests that have to wait
+    queue per chat, and freed slots go round-robin over the chats with
+    waiting requests, so one chat firing off ten questions doesn't push
+    everyone else to the back. Beyond `max_queue` waiting requests new ones
+    are refused right away instead of piling up until they time out.
+
+    Call from inside the running event loop.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 20):
+        """
+        Args:
+            workers (int): Generations allowed to run concurrently
+            max_queue (int): Requests allowed to wait for a slot
+        """
+        self.workers = workers
+        self.max_queue = max_queue
+        self.active = 0
+        self.stats = {'granted': 0, 'queued': 0, 'rejected': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+        self._queues: Dict[Hashable, Deque[asyncio.Future]] = {}
+        self._turns: Deque[Hashable] = deque()  # chats with waiting requests, in round-robin order
+
+    @property
+    def queued(self) -> int:
+        """Requests waiting for a slot."""
+        return sum(len(tickets) for tickets in self._queues.values())
+
+    def _position(self, chat: Hashable) -> int:
+        """Place in line of the newest request of a chat under round-robin dispatch."""
+        own = len(self._queues[chat])
+        return own + sum(min(len(tickets), own) for other, tickets in self._queues.items() if other != chat)
+
+    def _dispatch(self) -> None:
+        """Hand free slots to waiting requests, one chat at a time."""
+        while self.active < self.workers and self._turns:
+            chat = self._turns.popleft()
+            tickets = self._queues[chat]
+            ticket = tickets.popleft()
+            if tickets:
+                self._turns.append(chat)
+            else:
+                del self._queues[chat]
+            if ticket.done():
+                continue  # The waiter went away
+            self.active += 1
+            ticket.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, chat: Hashable = None, on_queued: Callable[[int], Awaitable] = None):
+        """
+        Hold a generation slot for the duration of the block.
+
+        Args:
+            chat (Hashable): Whose request this is, for fairness between chats
+            on_queued (Callable[[int], Awaitable]): Awaited with the place in line
+                when the request has to wait
+
+        Raises:
+            QueueFull: The wait queue is full
+        """
+        start = time.perf_counter()
+        if self.active < self.workers and not self._turns:
+            self.active += 1
+        else:
+            if self.queued >= self.max_queue:
+                self.stats['rejected'] += 1
+                raise QueueFull(self.queued)
+            ticket = asyncio.get_running_loop().create_future()
+            if chat not in self._queues:
+                self._queues[chat] = deque()
+                self._turns.append(chat)
+            self._queues[chat].append(ticket)
+            self.stats['queued'] += 1
+            try:
+                if on_queued is not None:
+                    await on_queued(self._position(chat))
+                await ticket
+            except BaseException:
+                # Cancelled, or on_queued failed: never leave the ticket behind,
+                # or it would be granted a slot nobody releases
+                if ticket.done() and not ticket.cancelled():
+                    # Granted just as we gave up: pass the slot on
+                    self.active -= 1
+                    self._dispatch()
+                else:
+                    ticket.cancel()
+                    tickets = self._queues.get(chat)
+                    if tickets is not None and ticket in tickets:
+                        tickets.remove(ticket)
+                        if not tickets:
+                            del self._queues[chat]
+                            self._turns.remove(chat)
+                raise
+            wait = time.perf_counter() - start
+            self.stats['wait_seconds'] += wait
+            self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], wait)
+            print(f"⏳ Waited {wait:.1f}s for a generation slot")
+
+        self.stats['granted'] += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._dispatch()
+
+    def report(self) -> str:
+        """Return load and queue-wait metrics."""
+        stats = self.stats
+        average = stats['wait_seconds'] / stats['queued'] if stats['queued'] else 0.0
+        return (f"Generations: {self.active}/{self.workers} running, {self.queued}/{self.max_queue} waiting; "
+                f"{stats['granted']} run, {stats['queued']} had to wait (avg {average:.1f}s, max {stats['max_wait_seconds']:.1f}s), "
+                f"{stats['rejected']} turned away")
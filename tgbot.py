@@ -1,10 +1,11 @@
 import logging, requests, constants, PyPDF2, os, math
 from pathlib import Path
-import time
-import pdfworker, nltkworker, ollamaworker
+import time, asyncio
+from datetime import timedelta
+import pdfworker, nltkworker, ollamaworker, llmworker
 
-import openai 
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ApplicationBuilder, Application, CommandHandler, ContextTypes, MessageHandler, filters
 
 datadirs = []
@@ -20,7 +21,12 @@ logging.basicConfig(
 
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
-AIClient = openai.OpenAI(api_key=constants.openaiAPI, timeout=30)
+# Summaries and the file-name based answers go to OpenAI, document QA to ollamaworker's backend
+AIBackend = llmworker.create_backend("openai", api_key=constants.openaiAPI, generation_model="gpt-4o-mini", timeout=30)
+
+STREAM_ANSWERS = True
+STREAM_EDIT_INTERVAL = 1.5 # seconds between edits of a streamed answer, Telegram floods at about 1 edit/sec per chat
+TELEGRAM_MESSAGE_LIMIT = 4096
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -33,13 +39,103 @@ async def kitty(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    answer = ollama_single_question(update.message.text)
+    chat_id = update.effective_chat.id
+
+    async def queued(position):
+        await context.bot.send_message(chat_id=chat_id, text="⏳ Busy, you are #" + str(position) + " in line")
+
+    if STREAM_ANSWERS:
+        fragments = ollamaworker.ask_ollama_qa_stream(update.message.text, "data", context.chat_data.get('shard'), chat_id, queued)
+        await stream_answer(context, chat_id, fragments)
+        return
+
+    # Awaited over a pooled async client, other chats keep being served meanwhile
+    answer = await ollama_single_question_async(update.message.text, shard=context.chat_data.get('shard'), chat=chat_id, on_queued=queued)
     # answer = ask_openai_about_documents(get_directory_listing_compact(), update.message.text)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=answer)
 
+async def edit_streamed_message(context: ContextTypes.DEFAULT_TYPE, message, text: str) -> float:
+    """
+    Edit a message holding a streamed answer.
+
+    Returns:
+        float: Seconds Telegram asked us to wait before the next edit (0 if the edit went through)
+    """
+    try:
+        await context.bot.edit_message_text(text=text, chat_id=message.chat_id, message_id=message.message_id)
+    except RetryAfter as e:
+        delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+        logging.log(level=logging.WARNING, msg="Flood control on answer edits, waiting " + str(delay) + "s")
+        return delay
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return 0.0
+
+async def finish_streamed_message(context: ContextTypes.DEFAULT_TYPE, message, text: str):
+    """Make sure a streamed message ends up showing the given text."""
+    delay = await edit_streamed_message(context, message, text)
+    if delay:
+        await asyncio.sleep(delay)
+        await edit_streamed_message(context, message, text)
+
+async def stream_answer(context: ContextTypes.DEFAULT_TYPE, chat_id, fragments):
+    """
+    Show an answer while it is being generated: one message is edited with
+    the text so far, at most once every STREAM_EDIT_INTERVAL seconds (longer if
+    Telegram asks us to back off). Text beyond the message limit continues in
+    a new message.
+
+    Args:
+        context: Handler context
+        chat_id: Chat to answer in
+        fragments: Async iterator of answer fragments
+    """
+    start = time.monotonic()
+    message = await context.bot.send_message(chat_id=chat_id, text="🤔 ...")
+    text = ""
+    shown = ""
+    next_edit = 0.0
+    first_fragment = True
+
+    async for fragment in fragments:
+        if first_fragment and fragment.strip():
+            logging.log(level=logging.INFO, msg="First answer text after " + str(round(time.monotonic() - start, 2)) + "s")
+            first_fragment = False
+        text += fragment
+
+        # Full message: settle it and carry on in a new one
+        while len(text) > TELEGRAM_MESSAGE_LIMIT:
+            if message is None:
+                await context.bot.send_message(chat_id=chat_id, text=text[:TELEGRAM_MESSAGE_LIMIT])
+            else:
+                await finish_streamed_message(context, message, text[:TELEGRAM_MESSAGE_LIMIT])
+            # Telegram rejects empty messages: the next one starts at the next non-blank text
+            text = text[TELEGRAM_MESSAGE_LIMIT:].lstrip()
+            message = None
+
+        if message is None:
+            text = text.lstrip()
+            if not text:
+                continue
+            message = await context.bot.send_message(chat_id=chat_id, text=text)
+            shown = text
+            next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+        if text.strip() and text != shown and time.monotonic() >= next_edit:
+            delay = await edit_streamed_message(context, message, text)
+            if not delay:
+                shown = text
+            next_edit = time.monotonic() + max(STREAM_EDIT_INTERVAL, delay)
+
+    if message is not None and text.strip() and text != shown:
+        if time.monotonic() < next_edit:
+            await asyncio.sleep(next_edit - time.monotonic())
+        await finish_streamed_message(context, message, text)
+
 def ask_openai_about_documents(directory_listing: str, user_question: str, directory_path: str = "data") -> str:
     """
-    Uses OpenAI GPT-4o-mini to find relevant documents and answer user question.
+    Uses AIBackend (OpenAI GPT-4o-mini) to find relevant documents and answer user question.
     
     Args:
         directory_listing (str): String containing the directory listing
@@ -66,17 +162,14 @@ def ask_openai_about_documents(directory_listing: str, user_question: str, direc
         
         print("🔍 Analyzing directory structure to find relevant documents...")
         
-        document_response = AIClient.chat.completions.create(
-            model="gpt-4o-mini",
+        recommended_files_text = AIBackend.chat(
             messages=[
                 {"role": "system", "content": "You are a helpful assistant that identifies relevant documents based on file names and directory structure."},
                 {"role": "user", "content": document_selection_prompt}
             ],
             max_tokens=500,
             temperature=0.1
-        )
-        
-        recommended_files_text = document_response.choices[0].message.content.strip()
+        ).strip()
         
         print(recommended_files_text)
 
@@ -164,17 +257,14 @@ def ask_openai_about_documents(directory_listing: str, user_question: str, direc
         If the answer cannot be found in the documents, please state that clearly.
         """
         
-        answer_response = AIClient.chat.completions.create(
-            model="gpt-4o-mini",
+        final_answer = AIBackend.chat(
             messages=[
                 {"role": "system", "content": "You are a helpful assistant that answers questions based on provided document contents."},
                 {"role": "user", "content": answer_prompt}
             ],
             max_tokens=1000,
             temperature=0.3
-        )
-        
-        final_answer = answer_response.choices[0].message.content.strip()
+        ).strip()
         
         # Add source information
         source_files = list(file_contents.keys())
@@ -188,16 +278,16 @@ def ask_openai_about_documents(directory_listing: str, user_question: str, direc
     
 async def clearContext(update: Update, context: ContextTypes.DEFAULT_TYPE):
   context.user_data['conversation'] = None
+  # Next question starts from scratch instead of following up on the documents discussed so far
+  if ollamaworker.clear_conversation(update.effective_chat.id):
+    await context.bot.send_message(update.effective_chat.id, text="🧹 Conversation cleared")
 
 
 async def setup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pdfworker.create_directories()
 
 def measure_tokens(messages):
-    sum = 0
-    for message in messages:
-        sum += nltkworker.count_tokens(message["content"])
-    return sum
+    return nltkworker.count_message_tokens(messages)
 
 def get_directory_listing_compact(directory_path=""):
     """
@@ -261,31 +351,32 @@ async def reprocess(update: Update, context: ContextTypes.DEFAULT_TYPE):
             tokenSum = initPromptTokenSum
             doneChunks = 0
             finalDoc = ""
-            chunks = pdfworker.process_pdf_to_chunks(path, 9500)
-            
-            logging.log(level=logging.INFO, msg="count of chunks: " + str(len(chunks)))
+            # Chunks are extracted page by page while we go, progress is counted in pages
+            pages = {'done': 0, 'total': 0}
+            chunks = pdfworker.process_pdf_to_chunks(path, 9500, lambda done, total: pages.update(done=done, total=total))
+            # Pages done when each chunk came out: mark_last reads one chunk ahead, so pages['done'] is ahead too
+            chunks = ((chunk, pages['done']) for chunk in chunks)
             
             percentMessage = await context.bot.send_message(update.effective_chat.id, text="0%")
+            shownProgress = "0%"
 
 
-            for chunk in chunks:
+            for (chunk, pagesDone), isLastChunk in pdfworker.mark_last(chunks):
                 shortened = nltkworker.shorten_technical_text(chunk)
                 
                 tokenCount = nltkworker.count_tokens(shortened)
 
-                if (tokenSum + tokenCount >= 40000 or doneChunks + 1 == len(chunks)):
+                if (tokenSum + tokenCount >= 40000 or isLastChunk):
                     logging.log(level=logging.INFO, msg="Talking to AI...")
                     await context.bot.edit_message_text(text="Talking to AI...", message_id=percentMessage.message_id, chat_id=percentMessage.chat_id)
+                    shownProgress = "Talking to AI..."
 
-                    response = AIClient.chat.completions.create(
+                    finalDoc = AIBackend.chat(
                         messages=messages,
-                        model="gpt-4o-mini",
                         temperature=0.6,
                         max_tokens=8000  # Lower temperature for more deterministic output
                     )
 
-                    finalDoc = response.choices[0].message.content
-
                     messages.clear()
                     messages.append(initPrompt)
                     messages.append({"role": "system", "content": "Next message is the content you have already summarized. Rest ones are remaining content to summarize. Continue working on it"})
@@ -293,9 +384,9 @@ async def reprocess(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     
                     logging.log(level=logging.INFO, msg=messages)
 
-                    tokenSum = nltkworker.count_tokens(messages[0]["content"] + messages[1]["content"] + messages[2]["content"])
+                    tokenSum = measure_tokens(messages)
 
-                    logging.log(level=logging.INFO, msg=response.choices[0].message)
+                    logging.log(level=logging.INFO, msg=finalDoc)
                     
                     sleepmsg = await context.bot.send_message(update.effective_chat.id, text="sleeping for some time cuz of limit of 6ok tokens per minute (but it blocks for more bruh)")
                     time.sleep(300) # 60k tokens is 1 min limit so we sleep it
@@ -317,7 +408,14 @@ async def reprocess(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 doneChunks += 1
                 
-                await context.bot.edit_message_text(text=str(doneChunks / len(chunks) * 100) + "%", message_id=percentMessage.message_id, chat_id=percentMessage.chat_id)
+                # Pages behind the chunk just processed (all of them after the last one). Several chunks
+                # can come out of one page, and Telegram refuses edits that change nothing
+                progress = str((pages['total'] if isLastChunk else pagesDone) / max(pages['total'], 1) * 100) + "%"
+                if progress != shownProgress:
+                    await context.bot.edit_message_text(text=progress, message_id=percentMessage.message_id, chat_id=percentMessage.chat_id)
+                    shownProgress = progress
+
+            logging.log(level=logging.INFO, msg="count of chunks: " + str(doneChunks))
 
             #save summ of pdf file
             pdf_filename = os.path.basename(path)
@@ -329,15 +427,50 @@ async def reprocess(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f.write(finalDoc)
             await context.bot.send_message(update.effective_chat.id, text="done with this one")
 
-def ollama_single_question(question, directory_path = "data"):        
-    answer = ollamaworker.ask_ollama_qa(question, directory_path)
+def ollama_single_question(question, directory_path = "data", shard = None):        
+    answer = ollamaworker.ask_ollama_qa(question, directory_path, shard)
+    return answer
+
+async def ollama_single_question_async(question, directory_path = "data", shard = None, chat = None, on_queued = None):
+    answer = await ollamaworker.ask_ollama_qa_async(question, directory_path, shard, chat, on_queued)
     return answer
 
+async def closeOllama(application: Application):
+    await ollamaworker.close_ollama_qa()
+    await AIBackend.aclose()
+
+async def fastPath(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    mode = ' '.join(context.args).lower()
+    if mode in ("on", "off"):
+        ollamaworker.qa_system.fast_path = mode == "on"
+    await context.bot.send_message(update.effective_chat.id, text=ollamaworker.qa_system.fast_path_report())
+
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    qa = ollamaworker.qa_system
+    await context.bot.send_message(update.effective_chat.id, text="\n".join([qa.status_report(), qa.single_flight.report(), qa.scheduler.report(), qa.latency_report(), qa.conversations.report()]))
+
+async def pinShard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    shard = ' '.join(context.args)
+    shards = ollamaworker.qa_system.index.shard_names
+
+    if shard == "":
+        context.chat_data['shard'] = None
+        await context.bot.send_message(update.effective_chat.id, text="Unpinned, searching shards picked per question:\n" + "\n".join(shards))
+    elif shard in shards:
+        context.chat_data['shard'] = shard
+        logging.log(level=logging.INFO, msg="Chat " + str(update.effective_chat.id) + " pinned to " + shard)
+        await context.bot.send_message(update.effective_chat.id, text="Pinned to " + shard)
+    else:
+        await context.bot.send_message(update.effective_chat.id, text="There is no such shard")
+
 async def getDirs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(update.effective_chat.id, text="\n".join(datadirs))
 
 if __name__ == '__main__':
-    application = ApplicationBuilder().token(constants.telegramToken).build()
+    # Handle updates concurrently, so a slow (or streaming) answer in one chat doesn't hold up the others;
+    # generation itself is bounded by the scheduler in ollamaworker
+    application = (ApplicationBuilder().token(constants.telegramToken).concurrent_updates(True)
+                   .post_shutdown(closeOllama).build())
     start_handler = CommandHandler('start', start)
     kitty_handler = CommandHandler('kitty', kitty)
     clear_handler = CommandHandler('clear', clearContext)
@@ -345,11 +478,15 @@ if __name__ == '__main__':
     reprocess_handler = CommandHandler('reprocess', reprocess)
     dirs_handler = CommandHandler('dirs', getDirs)
     docs_handler = CommandHandler('docs', getDocs)
+    fastpath_handler = CommandHandler('fastpath', fastPath)
+    pin_handler = CommandHandler('pin', pinShard)
+    status_handler = CommandHandler('status', status)
     message_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, ai)
 
-    application.add_handlers([start_handler, kitty_handler, message_handler, setup_handler, reprocess_handler, dirs_handler, docs_handler])
+    application.add_handlers([start_handler, kitty_handler, clear_handler, message_handler, setup_handler, reprocess_handler, dirs_handler, docs_handler, fastpath_handler, pin_handler, status_handler])
 
-    ollamaworker.setup_ollama_qa('/home/pe4enushko/Documents/Literature/')
+    # Index (and watch) the data directories, where /reprocess writes its summaries
+    ollamaworker.setup_ollama_qa('./data/')
 
     datadirs = pdfworker.get_data_dirs()
 
@@ -0,0 +1,125 @@
+import os
+import time
+import threading
+from typing import Callable, Dict, List, Tuple
+
+
+def snapshot_directory(directory_path: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Return (mtime_ns, size) of every file under a directory, keyed by path.
+    Hidden files and directories (like a .docbot_index next to the data) are skipped.
+
+    Args:
+        directory_path (str): Directory to scan
+
+    Returns:
+        Dict[str, Tuple[int, int]]: path -> (mtime_ns, size)
+    """
+    snapshot = {}
+    stack = [directory_path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue  # Removed or unreadable while we were scanning
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                continue
+    return snapshot
+
+
+class DirectoryWatcher:
+    """
+    Polling watcher over one or more directories, stdlib only.
+
+    Every `interval` seconds the trees are snapshotted (mtime and size per
+    file) and compared with the previous snapshot. A changed, added or removed
+    file is reported once it has been quiet for `debounce` seconds, so a file
+    that is rewritten several times in a row (like the intermediate summaries
+    /reprocess writes) is handed to `on_change` once, with its final content.
+    """
+
+    def __init__(self, directories: List[str], on_change: Callable[[List[str]], None],
+                 interval: float = 2.0, debounce: float = 5.0):
+        """
+        Args:
+            directories (List[str]): Directories to watch recursively
+            on_change (Callable[[List[str]], None]): Called from the watcher thread
+                with the settled paths (changed, added or removed)
+            interval (float): Seconds between snapshots
+            debounce (float): Seconds a file has to stay unchanged before it is reported
+        """
+        self.directories = directories
+        self.on_change = on_change
+        self.interval = interval
+        self.debounce = debounce
+        self.stats = {'polls': 0, 'changes_seen': 0, 'paths_reported': 0}
+        self._snapshot = {}
+        self._pending = {}  # path -> monotonic time of its last change
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for directory in self.directories:
+            snapshot.update(snapshot_directory(directory))
+        return snapshot
+
+    def poll(self) -> List[str]:
+        """
+        Take one snapshot and return the paths that have settled since the
+        last change to them. Normally called by the watcher thread.
+
+        Returns:
+            List[str]: Settled paths, sorted
+        """
+        now = time.monotonic()
+        snapshot = self._scan()
+        changed = {path for path, state in snapshot.items() if self._snapshot.get(path) != state}
+        changed |= self._snapshot.keys() - snapshot.keys()
+        self._snapshot = snapshot
+        self.stats['polls'] += 1
+        self.stats['changes_seen'] += len(changed)
+
+        # Another write restarts the quiet period, coalescing rapid rewrites into one report
+        for path in changed:
+            self._pending[path] = now
+        settled = sorted(path for path, changed_at in self._pending.items() if now - changed_at >= self.debounce)
+        for path in settled:
+            del self._pending[path]
+        return settled
+
+    def start(self) -> None:
+        """Take the baseline snapshot and start polling in a daemon thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._snapshot = self._scan()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="directory-watcher", daemon=True)
+        self._thread.start()
+        print(f"👀 Watching {', '.join(self.directories)} ({len(self._snapshot)} files, "
+              f"every {self.interval:g}s, debounce {self.debounce:g}s)")
+
+    def stop(self) -> None:
+        """Stop the watcher thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                settled = self.poll()
+                if settled:
+                    self.stats['paths_reported'] += len(settled)
+                    self.on_change(settled)
+            except Exception as e:
+                print(f"✗ Watcher error: {e}")